@@ -18,8 +18,16 @@ fi
 # Make migrations and migrate the database.
 echo "Making migrations and migrating the database. "
 python manage.py makemigrations main --noinput 
+# The unique (product, offerer) constraint can't be added while duplicate offers exist.
+python manage.py delete_duplicate_offers
 python manage.py migrate --noinput 
 
+# Recompute denormalized image reference counts and search vectors. Profile ratings are kept
+# up to date by the outbox; `manage.py rebuild_ratings` repairs them by hand if needed.
+echo "Rebuilding image reference counts and search vectors..."
+python manage.py rebuild_image_refs
+python manage.py update_search_vectors
+
 
 if [ "$SEARCH" = "elasticsearch" ]; then
 # Wait for the Elasticsearch server to start up.
@@ -34,9 +42,9 @@ if [ "$SEARCH" = "elasticsearch" ]; then
     done
 
     echo "Elasticsearch started"
-# Rebuild the elasticsearch index.
+# Rebuild the search index into a new version and switch over to it; search stays up meanwhile.
     echo "Rebuilding search index..."
-    printf 'y\n' | python manage.py search_index --rebuild 
+    python manage.py rebuild_search_index
 fi
 
 exec "$@"
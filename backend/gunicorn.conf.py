@@ -0,0 +1,7 @@
+# Gunicorn picks this file up from the working directory.
+
+
+def worker_exit(server, worker):
+    from marketplace.schema import document_backend
+
+    server.log.info(f"GraphQL document cache: {document_backend.documents.stats()}")
@@ -1,20 +1,10 @@
-import random
-
 from django.contrib.auth.decorators import user_passes_test
+from django.db import transaction
 from rest_framework_jwt.settings import api_settings
 
 from main.models import Product, User
 
 
-def generate_random_password():
-
-    s = "abcdefghijklmnopqrstuvwxyz01234567890ABCDEFGHIJKLMNOPQRSTUVWXYZ!@#$%^&*()?"
-    passlen = 8
-    p = "".join(random.sample(s, passlen))
-
-    return p
-
-
 def get_jwt_with_user(user):
     jwt_payload_handler = api_settings.JWT_PAYLOAD_HANDLER
     jwt_encode_handler = api_settings.JWT_ENCODE_HANDLER
@@ -22,14 +12,27 @@ def get_jwt_with_user(user):
     token = jwt_encode_handler(payload)
     return token
 
+def get_user_by_natural_key(username):
+    """
+    JWT_GET_USER_BY_NATURAL_KEY_HANDLER that loads the user's profile and wishlist in the
+    same query, since most resolvers and permission checks read them.
+    """
+    try:
+        return User.objects.select_related("profile__wishlist").get(username=username)
+    except User.DoesNotExist:
+        return None
+
 def create_user_from_email(email):
+    """
+    Create a user with their profile and wishlist (see models.create_or_update_profile)
+    in one transaction, with one INSERT each.
+    Users only sign in through Google, so they get an unusable password instead of a hashed one.
+    """
     username, _ = email.split("@")
-    user = User(username=username, email=email)
-    user.save()
-    password = generate_random_password()
-    user.set_password(password)
-    user.profile.email = email
-    user.profile.save()
+    with transaction.atomic():
+        user = User(username=username, email=email)
+        user.set_unusable_password()
+        user.save(force_insert=True)
     return user
 
 def create_product_from_email(email, is_negotiable):
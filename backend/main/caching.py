@@ -0,0 +1,51 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Cached values are grouped under tags. Every tag has a version number that is part of
+# the cache keys built from it, so bumping the version invalidates all of them at once.
+TAG_VERSION_PREFIX = "tag-version"
+# Profile.tokens_valid_after of a user, see main.tokens.
+TOKENS_VALID_AFTER_PREFIX = "tokens-valid-after"
+
+
+def tag_version(tag):
+    key = f"{TAG_VERSION_PREFIX}:{tag}"
+    version = cache.get(key)
+    if version is None:
+        version = 1
+        cache.add(key, version, None)
+    return version
+
+
+def invalidate_tags(*tags):
+    for tag in tags:
+        key = f"{TAG_VERSION_PREFIX}:{tag}"
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Nothing has been cached under this tag yet.
+            cache.set(key, 2, None)
+
+
+def make_key(prefix, tags, *parts):
+    """
+    Build a cache key from `parts` that changes whenever one of `tags` is invalidated.
+    """
+    versions = ",".join(f"{tag}={tag_version(tag)}" for tag in sorted(tags))
+    digest = hashlib.sha1("\0".join(str(part) for part in parts).encode("utf8")).hexdigest()
+    return f"{prefix}:{versions}:{digest}"
+
+
+def cache_tokens_valid_after(user_id, timestamp):
+    """
+    Cache the timestamp before which a user's tokens aren't trusted, 0 if they all are.
+    Only a copy of Profile.tokens_valid_after: a missing entry means it must be read again.
+    """
+    key = f"{TOKENS_VALID_AFTER_PREFIX}:{user_id}"
+    cache.set(key, timestamp, settings.TOKEN_REVOCATION_CACHE_TIMEOUT)
+
+
+def cached_tokens_valid_after(user_id):
+    return cache.get(f"{TOKENS_VALID_AFTER_PREFIX}:{user_id}")
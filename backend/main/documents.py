@@ -2,8 +2,16 @@
 from django_elasticsearch_dsl.documents import Document
 from django_elasticsearch_dsl import fields
 from django_elasticsearch_dsl.registries import registry
+from elasticsearch_dsl import analyzer, token_filter
 from main.models import Profile, Product
 
+# Indexes every prefix of every word, so suggestions (main.search.elastic.build_suggestion_search) are a plain term lookup.
+autocomplete = analyzer(
+    "autocomplete",
+    tokenizer="standard",
+    filter=["lowercase", "asciifolding", token_filter("autocomplete_prefixes", "edge_ngram", min_gram=1, max_gram=20)],
+)
+
 
 # Commented this for now because it does not let you create a user. 
 # 
@@ -25,12 +33,53 @@ from main.models import Profile, Product
 
 @registry.register_document
 class ProductDocument(Document):
+    name = fields.TextField(fields={
+        "autocomplete": fields.TextField(analyzer=autocomplete, search_analyzer="standard"),
+    })
+    # Keyword fields used as filters and facets by main.search.elastic.
+    category = fields.KeywordField(attr="category.name")
+    seller_hostel = fields.KeywordField(attr="seller.hostel")
+    # Stored (not searched) so search results can be served from _source, see main.search.elastic.product_from_hit.
+    category_id = fields.IntegerField(attr="category_id", index=False)
+    seller_id = fields.IntegerField(attr="seller_id", index=False)
+    seller_name = fields.KeywordField(attr="seller.name", index=False)
+    images = fields.ObjectField(properties={
+        "image": fields.KeywordField(index=False),
+        "thumbnail": fields.KeywordField(index=False),
+        "medium": fields.KeywordField(index=False),
+        "large": fields.KeywordField(index=False),
+    })
+
     class Index:
         name = "products"
 
     class Django:
         model = Product
         fields = [
-            "name",
-            "description"
+            "id",
+            "description",
+            "expected_price",
+            "is_negotiable",
+            "is_ticket",
+            "sold",
+            "visible",
+            "expired",
+            "created_at",
+        ]
+        # Querysets are indexed a page at a time, so the images are prefetched once per page
+        # rather than once per product (as with .iterator()) or for the whole table at once.
+        queryset_pagination = 500
+
+    def get_queryset(self):
+        # Hidden and expired products are indexed too and filtered out at search time.
+        return (
+            Product._base_manager.select_related("category", "seller")
+            .prefetch_related("images")
+            .order_by("id")
+        )
+
+    def prepare_images(self, instance):
+        return [
+            {field: getattr(image, field).name for field in ("image", "thumbnail", "medium", "large")}
+            for image in instance.images.all()
         ]
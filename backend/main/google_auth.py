@@ -0,0 +1,70 @@
+import re
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+from google.auth import jwt
+
+# Google's OAuth 2.0 signing certificates, as {key id: x509 certificate}.
+GOOGLE_OAUTH2_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+# Used when the response doesn't say how long the certificates can be cached.
+DEFAULT_CERTS_MAX_AGE = 60 * 60
+CERTS_TIMEOUT = 5
+# Least time between two fetches forced by tokens signed with an unknown key, so invalid
+# tokens can't make every login fetch the certificates.
+MIN_CERTS_REFRESH_INTERVAL = 60
+
+MAX_AGE = re.compile(r"max-age=(\d+)")
+
+# Shared by all logins of a worker, so connections to Google are kept alive and reused.
+session = requests.Session()
+
+_certs = None
+_certs_fetched_at = 0
+_certs_expire_at = 0
+_certs_lock = threading.Lock()
+
+
+def get_max_age(response):
+    match = MAX_AGE.search(response.headers.get("Cache-Control", ""))
+    return int(match.group(1)) if match else DEFAULT_CERTS_MAX_AGE
+
+
+def get_certs(refresh=False):
+    """
+    Google's signing certificates, fetched again once the Cache-Control max-age of the
+    last response has passed, or on `refresh`.
+    """
+    global _certs, _certs_fetched_at, _certs_expire_at
+    with _certs_lock:
+        now = time.monotonic()
+        if _certs is None or refresh or now >= _certs_expire_at:
+            response = session.get(GOOGLE_OAUTH2_CERTS_URL, timeout=CERTS_TIMEOUT)
+            response.raise_for_status()
+            _certs = response.json()
+            _certs_fetched_at = now
+            _certs_expire_at = now + get_max_age(response)
+        return _certs
+
+
+def verify_id_token(id_token):
+    """
+    Verify a Google ID token against the cached certificates and return its claims.
+    Raises ValueError if the token is invalid.
+    """
+    try:
+        return jwt.decode(id_token, certs=get_certs())
+    except ValueError:
+        # Google may have rotated its keys before the cached certificates expired.
+        if time.monotonic() - _certs_fetched_at < MIN_CERTS_REFRESH_INTERVAL:
+            raise
+        return jwt.decode(id_token, certs=get_certs(refresh=True))
+
+
+def verify(id_token):
+    """
+    Verify an ID token with settings.GOOGLE_ID_TOKEN_VERIFIER.
+    """
+    return import_string(settings.GOOGLE_ID_TOKEN_VERIFIER)(id_token)
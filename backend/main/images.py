@@ -0,0 +1,154 @@
+import hashlib
+import os
+from datetime import timedelta
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from PIL import Image, ImageOps, features
+
+from main import indexing
+from main.caching import invalidate_tags
+from main.models import ImageModel, Product
+
+# Longest side in pixels of every rendition generated for an ImageModel, by field name.
+RENDITIONS = {
+    "thumbnail": 320,
+    "medium": 800,
+    "large": 1600,
+}
+
+# How long an image stays around after its last product let go of it, so that an upload
+# racing with the cleanup can still reference it.
+UNREFERENCED_GRACE_PERIOD = timedelta(hours=1)
+
+
+def file_hash(f):
+    sha256 = hashlib.sha256()
+    for chunk in f.chunks():
+        sha256.update(chunk)
+    f.seek(0)
+    return sha256.hexdigest()
+
+
+def content_path(sha256, filename):
+    """
+    Storage path of an image with the given hash. The path never changes for as long as the
+    file exists, so it can be cached forever.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    return f"images/{sha256[:2]}/{sha256}{extension}"
+
+
+def store_images(files):
+    """
+    Store uploaded files by content hash and return their ImageModels, in order, along with
+    the ones that still need their renditions generated.
+    A file whose content is already stored reuses the existing row and its renditions,
+    so a duplicate upload costs one hash instead of a write and a processing job.
+    """
+    hashes = [file_hash(f) for f in files]
+    existing = ImageModel.objects.in_bulk(set(hashes), field_name="sha256")
+
+    new = {}
+    for sha256, f in zip(hashes, files):
+        if sha256 in existing or sha256 in new:
+            continue
+        path = content_path(sha256, f.name)
+        if not default_storage.exists(path):
+            path = default_storage.save(path, f)
+        new[sha256] = ImageModel(image=path, sha256=sha256)
+
+    if new:
+        # A concurrent upload of the same content may have inserted it first.
+        ImageModel.objects.bulk_create(new.values(), ignore_conflicts=True)
+        existing = ImageModel.objects.in_bulk(set(hashes), field_name="sha256")
+
+    images = [existing[sha256] for sha256 in hashes]
+    unprocessed = [image for image in existing.values() if not image.thumbnail]
+    return images, unprocessed
+
+
+def collect_images():
+    """
+    Delete images (and their files) that no product has used for UNREFERENCED_GRACE_PERIOD.
+    Each image is locked and checked again right before it is deleted, so an image that an
+    upload has reused by hash in the meantime (see store_images) is kept, along with its files.
+    """
+    cutoff = timezone.now() - UNREFERENCED_GRACE_PERIOD
+    unused = (
+        ImageModel.objects.filter(ref_count__lte=0, unreferenced_at__lt=cutoff)
+        .annotate(linked=Exists(Product.images.through.objects.filter(imagemodel_id=OuterRef("pk"))))
+        .filter(linked=False)
+    )
+    count = 0
+    for pk in list(unused.values_list("id", flat=True)):
+        with transaction.atomic():
+            # Images locked by a concurrent write are left for the next run.
+            image = unused.select_for_update(skip_locked=True).filter(pk=pk).first()
+            if image is not None:
+                # The files go with the row, see models.delete_image_files.
+                image.delete()
+                count += 1
+    return count
+
+
+def get_format():
+    """
+    WebP if Pillow was built with it, JPEG otherwise.
+    """
+    if features.check("webp"):
+        return "WEBP", "webp"
+    return "JPEG", "jpg"
+
+
+def render(image, max_size, fmt):
+    """
+    Resize a copy of `image` to fit in a `max_size` square and encode it.
+    The output is written without any of the original's metadata, so EXIF (location,
+    camera details) is stripped.
+    """
+    rendition = image.copy()
+    rendition.thumbnail((max_size, max_size), Image.LANCZOS)
+    out = BytesIO()
+    rendition.save(out, format=fmt, quality=80, optimize=True)
+    return ContentFile(out.getvalue())
+
+
+def process_image(image_id):
+    """
+    Generate the renditions of an uploaded image and save them on its ImageModel.
+    Only the rendition columns are updated, so this is safe to run again.
+    """
+    instance = ImageModel.objects.filter(pk=image_id).first()
+    if instance is None or not instance.image:
+        return None
+
+    with instance.image.open("rb") as f:
+        image = Image.open(f)
+        image.load()
+        # Apply the EXIF orientation before it is dropped.
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+    fmt, extension = get_format()
+    if fmt == "JPEG" and image.mode == "RGBA":
+        image = image.convert("RGB")
+
+    name = os.path.splitext(os.path.basename(instance.image.name))[0]
+    renditions = {}
+    for field, max_size in RENDITIONS.items():
+        path = default_storage.save(f"thumbs/{name}_{field}.{extension}", render(image, max_size, fmt))
+        renditions[field] = path
+
+    ImageModel.objects.filter(pk=image_id).update(**renditions)
+    # update() sends no post_save, see models.invalidate_cache_tags.
+    invalidate_tags(ImageModel._meta.label_lower)
+    # Search results carry the rendition paths.
+    product_ids = Product.images.through.objects.filter(imagemodel_id=image_id).values_list("product_id", flat=True)
+    indexing.queue_objects(Product, list(product_ids))
+    return renditions
@@ -0,0 +1,197 @@
+import uuid
+from collections import defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import models
+from django_elasticsearch_dsl.apps import DEDConfig
+from django_elasticsearch_dsl.registries import registry
+from django_elasticsearch_dsl.signals import BaseSignalProcessor
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+
+# Redis set of "<app_label.model>:<pk>" entries waiting to be indexed.
+INDEX_QUEUE_KEY = "search-index-queue"
+# While REBUILD_FLAG_KEY is set, queued entries are also logged to REBUILD_LOG_KEY so that
+# rebuild_search_index can replay them into the index it is building.
+REBUILD_FLAG_KEY = "search-index-rebuilding"
+REBUILD_LOG_KEY = "search-index-rebuild-log"
+
+
+def get_indexed_fields(model):
+    """
+    Attribute names of the model fields that end up in one of the model's documents.
+    """
+    attnames = {}
+    for field in model._meta.concrete_fields:
+        attnames[field.name] = attnames[field.attname] = field.attname
+    return {
+        attnames[name]
+        for doc in registry.get_documents([model])
+        for name in doc._fields
+        if name in attnames
+    }
+
+
+def get_snapshot(instance, fields):
+    # Read __dict__ so deferred fields aren't loaded just for this.
+    return {field: instance.__dict__.get(field) for field in fields}
+
+
+def queue_for_indexing(entries):
+    redis = get_redis_connection("default")
+    pipeline = redis.pipeline()
+    pipeline.sadd(INDEX_QUEUE_KEY, *entries)
+    pipeline.scard(INDEX_QUEUE_KEY)
+    pipeline.exists(REBUILD_FLAG_KEY)
+    _, queued, rebuilding = pipeline.execute()
+    if rebuilding:
+        redis.sadd(REBUILD_LOG_KEY, *entries)
+    if queued >= settings.SEARCH_INDEX_BATCH_SIZE:
+        from main import tasks
+        tasks.flush_search_index.delay()
+
+
+def queue_objects(model, pks):
+    """
+    Queue objects changed without a save, e.g. with QuerySet.update().
+    """
+    if DEDConfig.autosync_enabled() and pks:
+        queue_for_indexing([f"{model._meta.label_lower}:{pk}" for pk in pks])
+
+
+def get_actions(doc, objects, action="index", index=None):
+    """
+    Bulk actions for `objects`, into the document's own index (usually an alias) or `index`.
+    """
+    for bulk_action in doc()._get_actions(objects, action):
+        if index is not None:
+            bulk_action["_index"] = index
+        yield bulk_action
+
+
+def index_entries(entries, indices=None):
+    """
+    Index the objects named by queue entries, and remove the ones that no longer exist.
+    `indices` optionally maps document classes to the index to write to.
+    """
+    pks = defaultdict(set)
+    for entry in entries:
+        label, pk = (entry.decode() if isinstance(entry, bytes) else entry).rsplit(":", 1)
+        pks[label].add(int(pk))
+
+    indices = indices or {}
+    for label, model_pks in pks.items():
+        model = apps.get_model(label)
+        for doc in registry.get_documents([model]):
+            # Objects the document doesn't index any more are removed as well.
+            existing = doc().get_queryset().in_bulk(model_pks)
+            deleted = [model(pk=pk) for pk in model_pks - existing.keys()]
+            index = indices.get(doc)
+            if existing:
+                doc().bulk(get_actions(doc, existing.values(), index=index))
+            if deleted:
+                doc().bulk(get_actions(doc, deleted, "delete", index=index), raise_on_error=False)
+
+
+def take_entries(key):
+    """
+    Atomically take all the entries from the Redis set `key`.
+    """
+    redis = get_redis_connection("default")
+    taken_key = f"{key}:{uuid.uuid4().hex}"
+    try:
+        # New entries start a fresh set.
+        redis.rename(key, taken_key)
+    except ResponseError:
+        # Nothing queued.
+        return set()
+    entries = redis.smembers(taken_key)
+    redis.delete(taken_key)
+    return entries
+
+
+def flush_search_index():
+    """
+    Index the queued objects with one bulk request per document, and remove the ones that no
+    longer exist from the index. Returns the number of objects flushed.
+    """
+    entries = take_entries(INDEX_QUEUE_KEY)
+    if not entries:
+        return 0
+    try:
+        index_entries(entries)
+    except Exception:
+        # Queue the entries again so the next flush retries them.
+        get_redis_connection("default").sadd(INDEX_QUEUE_KEY, *entries)
+        raise
+    return len(entries)
+
+
+def record_changes(model, pks):
+    from main.models import OutboxEvent
+    from main.outbox import record_events
+
+    record_events(OutboxEvent.INDEX, model, pks)
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """
+    Signal processor that records changed objects in the outbox, in the transaction that changed
+    them, instead of indexing them during the request. main.tasks.drain_outbox moves them to the
+    Redis queue, which is deduplicated and flushed with the bulk API by main.tasks.flush_search_index,
+    every SEARCH_INDEX_FLUSH_INTERVAL seconds or as soon as SEARCH_INDEX_BATCH_SIZE objects are queued.
+
+    Saves that don't change any indexed field (such as counter updates) are not queued.
+    Changes to the model's own many-to-many fields always are, since documents may store them.
+    Documents with related_models aren't supported.
+    """
+
+    def setup(self):
+        # Documents are registered by the time django_elasticsearch_dsl sets up the processor.
+        self.indexed_fields = {model: get_indexed_fields(model) for model in registry.get_models()}
+        for model in self.indexed_fields:
+            models.signals.post_init.connect(self.handle_init, sender=model)
+            models.signals.post_save.connect(self.handle_save, sender=model)
+            models.signals.post_delete.connect(self.handle_delete, sender=model)
+            for field in model._meta.local_many_to_many:
+                models.signals.m2m_changed.connect(self.handle_m2m_changed, sender=field.remote_field.through)
+
+    def teardown(self):
+        for model in self.indexed_fields:
+            models.signals.post_init.disconnect(self.handle_init, sender=model)
+            models.signals.post_save.disconnect(self.handle_save, sender=model)
+            models.signals.post_delete.disconnect(self.handle_delete, sender=model)
+            for field in model._meta.local_many_to_many:
+                models.signals.m2m_changed.disconnect(self.handle_m2m_changed, sender=field.remote_field.through)
+
+    def handle_init(self, sender, instance, **kwargs):
+        instance._indexed_snapshot = get_snapshot(instance, self.indexed_fields[sender])
+
+    def handle_save(self, sender, instance, created=False, update_fields=None, **kwargs):
+        fields = self.indexed_fields[sender]
+        if update_fields is not None and not fields.intersection(update_fields):
+            return
+
+        snapshot = get_snapshot(instance, fields)
+        if not created and snapshot == getattr(instance, "_indexed_snapshot", None):
+            return
+        instance._indexed_snapshot = snapshot
+        self.enqueue(instance)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        self.enqueue(instance)
+
+    def handle_m2m_changed(self, sender, instance, action, reverse, model, pk_set, **kwargs):
+        if action not in ("post_add", "post_remove", "post_clear"):
+            return
+        if not reverse:
+            self.enqueue(instance)
+        elif pk_set:
+            # instance is the other side, e.g. an image added to products.
+            if DEDConfig.autosync_enabled():
+                record_changes(model, pk_set)
+
+    def enqueue(self, instance):
+        if DEDConfig.autosync_enabled():
+            record_changes(instance._meta.model, [instance.pk])
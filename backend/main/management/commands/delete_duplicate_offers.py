@@ -0,0 +1,43 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count, F, Min
+
+from main.caching import invalidate_tags
+from main.models import Product, ProductOffer
+
+
+class Command(BaseCommand):
+    help = (
+        "Keep only the first offer of every buyer on a product. Run before migrating to the "
+        "unique (product, offerer) constraint, which can't be added while duplicates exist."
+    )
+
+    def handle(self, *args, **options):
+        if ProductOffer._meta.db_table not in connection.introspection.table_names():
+            # Nothing to clean up before the first migration.
+            return
+
+        with transaction.atomic():
+            duplicates = (
+                ProductOffer.objects.values("product", "offerer")
+                .annotate(first=Min("id"), count=Count("id"))
+                .filter(count__gt=1)
+            )
+            first_ids = [row["first"] for row in duplicates]
+            keys = {(row["product"], row["offerer"]) for row in duplicates}
+            extra = [
+                (offer_id, product_id)
+                for offer_id, product_id, offerer_id in ProductOffer.objects.filter(
+                    product__in={product for product, _ in keys}
+                ).exclude(id__in=first_ids).values_list("id", "product", "offerer")
+                if (product_id, offerer_id) in keys
+            ]
+            ProductOffer.objects.filter(id__in=[offer_id for offer_id, _ in extra]).delete()
+            # Product.num_offers counted the duplicates too.
+            for product_id, count in Counter(product_id for _, product_id in extra).items():
+                Product._base_manager.filter(pk=product_id).update(num_offers=F("num_offers") - count)
+        invalidate_tags(Product._meta.label_lower)
+
+        self.stdout.write(f"Deleted {len(extra)} duplicate offers.")
@@ -0,0 +1,48 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from main.models import Category, Product, ProductOffer, Profile, UserReport
+
+
+def sample_id(model):
+    return model._base_manager.order_by("-pk").values_list("pk", flat=True).first() or 0
+
+
+class Command(BaseCommand):
+    help = (
+        "Print the query plans and timings of the hot product, offer and report queries. "
+        "Run before and after a migration to compare the plans it changes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=20, help="Runs timed per query.")
+        parser.add_argument("--analyze", action="store_true", help="EXPLAIN ANALYZE (Postgres only).")
+
+    def get_queries(self):
+        profile_id, category_id, product_id = sample_id(Profile), sample_id(Category), sample_id(Product)
+        latest = Product.objects.order_by("-created_at").values_list("created_at", flat=True).first()
+        return {
+            "products page": Product.objects.order_by("created_at", "id")[:20],
+            "products after cursor": Product.objects.filter(created_at__lt=latest).order_by("created_at", "id")[:20]
+            if latest else Product.objects.none(),
+            "seller's products": Product.objects.filter(seller_id__in=[profile_id]).order_by("-created_at"),
+            "category's products": Product.objects.filter(category_id__in=[category_id]).order_by("-created_at"),
+            "duplicate offer check": ProductOffer.objects.filter(product_id=product_id, offerer_id=profile_id)[:1],
+            "reports of a user": UserReport.objects.filter(reported_user_id=profile_id),
+        }
+
+    def handle(self, *args, **options):
+        explain = {"analyze": True} if options["analyze"] and connection.vendor == "postgresql" else {}
+        for label, queryset in self.get_queries().items():
+            timings = []
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                list(queryset.all())
+                timings.append((time.perf_counter() - start) * 1000)
+
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{label}: {statistics.median(timings):.2f} ms (median)"))
+            self.stdout.write(queryset.explain(**explain))
+            self.stdout.write("")
@@ -0,0 +1,79 @@
+import csv
+import json
+import sys
+from collections import defaultdict
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+
+from main.models import Product
+
+EXPORT_FIELDS = ["name", "description", "expected_price", "category", "seller", "is_negotiable", "is_ticket", "images"]
+
+
+class Command(BaseCommand):
+    help = "Stream all visible products to a CSV or JSONL file in the format import_products reads."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", help="Output file, stdout if omitted.")
+        parser.add_argument("--format", choices=["csv", "jsonl"])
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or ("csv" if path and path.endswith(".csv") else "jsonl")
+        out = open(path, "w", newline="") if path else sys.stdout
+
+        try:
+            if fmt == "csv":
+                writer = csv.DictWriter(out, fieldnames=EXPORT_FIELDS)
+                writer.writeheader()
+                write = writer.writerow
+            else:
+                def write(row):
+                    out.write(json.dumps(row) + "\n")
+
+            count = 0
+            for row in self.iter_rows(options["chunk_size"]):
+                if fmt == "csv":
+                    row["images"] = "|".join(row["images"])
+                write(row)
+                count += 1
+        finally:
+            if path:
+                out.close()
+
+        self.stderr.write(f"Exported {count} products.")
+
+    def iter_rows(self, chunk_size):
+        """
+        Yield export rows with constant memory: products are streamed with .iterator() and
+        their image paths are fetched with one query per chunk.
+        """
+        rows = (
+            Product.objects.order_by("id")
+            .values("id", "name", "description", "expected_price", "category__name",
+                    "seller__user__username", "is_negotiable", "is_ticket")
+            .iterator(chunk_size=chunk_size)
+        )
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return
+
+            images = defaultdict(list)
+            through = Product.images.through.objects.filter(product_id__in=[row["id"] for row in chunk])
+            for product_id, image in through.values_list("product_id", "imagemodel__image"):
+                images[product_id].append(image)
+
+            for row in chunk:
+                yield {
+                    "name": row["name"],
+                    "description": row["description"],
+                    "expected_price": row["expected_price"],
+                    "category": row["category__name"],
+                    "seller": row["seller__user__username"],
+                    "is_negotiable": row["is_negotiable"],
+                    "is_ticket": row["is_ticket"],
+                    "images": images[row["id"]],
+                }
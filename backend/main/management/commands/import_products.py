@@ -0,0 +1,175 @@
+import csv
+import json
+from collections import Counter, defaultdict
+from functools import partial
+from itertools import islice
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from main import tasks
+from main.caching import invalidate_tags
+from main.documents import ProductDocument
+from main.images import store_images
+from main.models import (Category, ImageModel, Product, Profile,
+                         update_search_vectors)
+
+TRUE_VALUES = ("1", "true", "yes", "y")
+# Image files kept open at once while storing them, see Command.store_images.
+IMAGE_BATCH_SIZE = 100
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or "").strip().lower() in TRUE_VALUES
+
+
+def parse_images(value):
+    """
+    Image paths relative to MEDIA_ROOT, either a list (JSONL) or separated by `|` (CSV).
+    """
+    if isinstance(value, list):
+        return value
+    return [path for path in (value or "").split("|") if path]
+
+
+def read_rows(f, fmt):
+    if fmt == "csv":
+        yield from csv.DictReader(f)
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream products from a CSV or JSONL file into the database with bulk inserts. "
+        "Columns: name, description, expected_price, category, seller (username), "
+        "is_negotiable, is_ticket, images."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=["csv", "jsonl"])
+        parser.add_argument("--chunk-size", type=int, default=2000)
+        parser.add_argument("--skip-index", action="store_true", help="Don't index the products in Elasticsearch.")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or ("csv" if path.endswith(".csv") else "jsonl")
+        index = not options["skip_index"] and getattr(settings, "ELASTICSEARCH_DSL_AUTOSYNC", True)
+
+        self.categories = dict(Category.objects.values_list("name", "id"))
+        total = 0
+        with open(path, newline="") as f:
+            for chunk in chunks(read_rows(f, fmt), options["chunk_size"]):
+                with transaction.atomic():
+                    products = self.import_chunk(chunk)
+                    update_search_vectors(Product._base_manager.filter(pk__in=[product.pk for product in products]))
+                # bulk_create doesn't send post_save, so invalidate the cached counts and
+                # responses of every imported chunk here.
+                invalidate_tags(Product._meta.label_lower, Category._meta.label_lower, ImageModel._meta.label_lower)
+                if index:
+                    doc = ProductDocument()
+                    doc.update(doc.get_queryset().filter(pk__in=[product.pk for product in products]))
+                total += len(products)
+                self.stdout.write(f"Imported {total} products...")
+
+        self.stdout.write(self.style.SUCCESS(f"Imported {total} products."))
+
+    def get_category_ids(self, names):
+        missing = {name for name in names if name and name not in self.categories}
+        if missing:
+            Category.objects.bulk_create([Category(name=name) for name in missing], ignore_conflicts=True)
+            self.categories.update(Category.objects.filter(name__in=missing).values_list("name", "id"))
+        return self.categories
+
+    def import_chunk(self, rows):
+        categories = self.get_category_ids({row.get("category") for row in rows})
+        sellers = dict(
+            Profile.objects.filter(user__username__in={row.get("seller") for row in rows})
+            .values_list("user__username", "id")
+        )
+
+        products = []
+        for row in rows:
+            seller = row.get("seller")
+            if seller and seller not in sellers:
+                raise CommandError(f"Unknown seller {seller!r} in row {row!r}")
+            products.append(Product(
+                name=row["name"],
+                description=row.get("description", ""),
+                expected_price=int(row["expected_price"]),
+                category_id=categories.get(row.get("category")),
+                seller_id=sellers.get(seller),
+                is_negotiable=parse_bool(row.get("is_negotiable")),
+                is_ticket=parse_bool(row.get("is_ticket")),
+            ))
+        Product.objects.bulk_create(products)
+
+        links = [
+            (product.id, path)
+            for product, row in zip(products, rows)
+            for path in parse_images(row.get("images"))
+        ]
+        if links:
+            self.link_images(links)
+
+        return products
+
+    def store_images(self, paths):
+        """
+        Store the image files at `paths` (relative to MEDIA_ROOT) by content hash, like uploads,
+        and return their ImageModel ids by path. The renditions of new images are generated
+        in the background once the transaction commits.
+        """
+        image_ids = {}
+        for batch in chunks(sorted(paths), IMAGE_BATCH_SIZE):
+            try:
+                files = [default_storage.open(path, "rb") for path in batch]
+            except OSError as e:
+                raise CommandError(f"Could not open image: {e}")
+            try:
+                images, unprocessed = store_images(files)
+            finally:
+                for f in files:
+                    f.close()
+            image_ids.update((path, image.id) for path, image in zip(batch, images))
+            for image in unprocessed:
+                transaction.on_commit(partial(tasks.process_image.delay, image.id))
+        return image_ids
+
+    def link_images(self, links):
+        """
+        Link products to images by path, see store_images.
+        bulk_create sends no m2m_changed, so the reference counts are updated here.
+        """
+        links = set(links)
+        image_ids = self.store_images({path for _, path in links})
+
+        Through = Product.images.through
+        Through.objects.bulk_create(
+            [Through(product_id=product_id, imagemodel_id=image_ids[path]) for product_id, path in links],
+            ignore_conflicts=True,
+        )
+
+        references = Counter(image_ids[path] for _, path in links)
+        by_count = defaultdict(list)
+        for image_id, count in references.items():
+            by_count[count].append(image_id)
+        for count, ids in by_count.items():
+            ImageModel.objects.filter(pk__in=ids).update(ref_count=F("ref_count") + count, unreferenced_at=None)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from main import images, tasks
+from main.models import ImageModel
+
+
+class Command(BaseCommand):
+    help = "Generate the missing renditions of product images, e.g. for images uploaded before they existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sync", action="store_true", help="Process the images here instead of in celery.")
+
+    def handle(self, *args, **options):
+        ids = ImageModel.objects.filter(thumbnail="").values_list("id", flat=True).iterator()
+        count = 0
+        for image_id in ids:
+            if options["sync"]:
+                images.process_image(image_id)
+            else:
+                tasks.process_image.delay(image_id)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"{'Processed' if options['sync'] else 'Queued'} {count} images."))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.utils import timezone
+
+from main.models import ImageModel, Product
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the reference counts of every image from the products using it. Only the "
+        "images whose count differs are written, and no rows are locked."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        changed = []
+        now = timezone.now()
+        links = dict(
+            Product.images.through.objects.values_list("imagemodel_id").annotate(count=Count("product_id"))
+        )
+        images = ImageModel.objects.only("id", "ref_count", "unreferenced_at")
+        for image in images.iterator():
+            ref_count = links.get(image.id, 0)
+            if image.ref_count != ref_count:
+                image.ref_count = ref_count
+                image.unreferenced_at = now if ref_count == 0 else None
+                changed.append(image)
+        ImageModel.objects.bulk_update(changed, ["ref_count", "unreferenced_at"], batch_size=options["batch_size"])
+
+        self.stdout.write(f"Updated the reference counts of {len(changed)} images.")
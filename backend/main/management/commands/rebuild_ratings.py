@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+
+from main.caching import invalidate_tags
+from main.models import Profile, ProfileRating
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the rating aggregates of every profile from ProfileRating. A manual repair "
+        "command: only the profiles whose aggregates differ are written, and no rows are locked."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        changed = []
+        aggregates = {
+            row["rating_for"]: (row["total"], row["count"])
+            for row in ProfileRating.objects.values("rating_for").annotate(
+                total=Sum("rating"), count=Count("id")
+            )
+        }
+        profiles = Profile.objects.only("id", "rating_sum", "num_ratings")
+        for profile in profiles.iterator():
+            rating_sum, num_ratings = aggregates.get(profile.id, (0, 0))
+            if (profile.rating_sum, profile.num_ratings) != (rating_sum, num_ratings):
+                profile.rating_sum = rating_sum
+                profile.num_ratings = num_ratings
+                changed.append(profile)
+        Profile.objects.bulk_update(changed, ["rating_sum", "num_ratings"], batch_size=options["batch_size"])
+        if changed:
+            invalidate_tags(Profile._meta.label_lower)
+
+        self.stdout.write(f"Updated the ratings of {len(changed)} profiles.")
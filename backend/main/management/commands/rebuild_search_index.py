@@ -0,0 +1,139 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max, Min
+from django_elasticsearch_dsl.registries import registry
+from django_redis import get_redis_connection
+from elasticsearch_dsl.connections import connections as es_connections
+
+from main.indexing import (REBUILD_FLAG_KEY, REBUILD_LOG_KEY, get_actions,
+                           index_entries, take_entries)
+
+# Upper bound on a rebuild, after which another one may start.
+REBUILD_TIMEOUT = 6 * 60 * 60
+
+
+class Command(BaseCommand):
+    help = (
+        "Build a new versioned index (<alias>_v<n>) for every search document, then atomically point "
+        "the document's alias at it. Search keeps being served by the old index until the swap."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="Primary key ranges indexed in parallel.")
+        parser.add_argument("--chunk-size", type=int, default=5000, help="Primary keys per range.")
+        parser.add_argument("--keep", type=int, default=1, help="Old index versions to keep for rollbacks.")
+
+    def handle(self, *args, **options):
+        self.es = es_connections.get_connection()
+        redis = get_redis_connection("default")
+        # Also serves as a lock, since every container runs this at boot.
+        if not redis.set(REBUILD_FLAG_KEY, 1, nx=True, ex=REBUILD_TIMEOUT):
+            self.stdout.write("A search index rebuild is already running.")
+            return
+        redis.delete(REBUILD_LOG_KEY)
+
+        built = {}
+        try:
+            try:
+                for doc in registry.get_documents():
+                    built[doc] = self.build(doc, options["workers"], options["chunk_size"])
+                # Replay the changes made while building.
+                if not self.catch_up(built):
+                    raise CommandError("Changes keep coming in faster than they can be replayed.")
+            except Exception:
+                for index in built.values():
+                    self.es.indices.delete(index=index, ignore=[404])
+                raise
+
+            for doc, index in built.items():
+                self.swap(doc, index)
+            # Changes flushed to the old indices between the last catch up and the swap.
+            self.catch_up(built)
+        finally:
+            redis.delete(REBUILD_FLAG_KEY, REBUILD_LOG_KEY)
+
+        for doc in built:
+            self.delete_old_versions(doc._index._name, options["keep"])
+
+    def get_versions(self, alias):
+        pattern = re.compile(rf"^{re.escape(alias)}_v(\d+)$")
+        versions = {}
+        for name in self.es.indices.get(index=f"{alias}_v*"):
+            match = pattern.match(name)
+            if match:
+                versions[int(match.group(1))] = name
+        return versions
+
+    def build(self, doc, workers, chunk_size):
+        alias = doc._index._name
+        name = f"{alias}_v{max(self.get_versions(alias), default=0) + 1}"
+        index = doc._index.clone(name=name)
+        replicas = index._settings.get("number_of_replicas", 1)
+        # Build without replicas or refreshes, which only slow down the bulk load.
+        index.settings(number_of_replicas=0, refresh_interval="-1")
+        index.create()
+        self.stdout.write(f"Building {name}...")
+
+        bounds = doc().get_queryset().aggregate(low=Min("pk"), high=Max("pk"))
+        if bounds["low"] is not None:
+            ranges = [
+                (low, low + chunk_size)
+                for low in range(bounds["low"], bounds["high"] + 1, chunk_size)
+            ]
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                total = sum(pool.map(partial(self.index_range, doc, name), ranges))
+            self.stdout.write(f"Indexed {total} {doc.django.model._meta.verbose_name_plural} into {name}.")
+
+        self.es.indices.put_settings(
+            index=name,
+            body={"index": {"number_of_replicas": replicas, "refresh_interval": None}},
+        )
+        self.es.indices.refresh(index=name)
+        return name
+
+    def index_range(self, doc, index, pk_range):
+        low, high = pk_range
+        try:
+            # Not .iterator(), which skips prefetch_related: the document pages through the range.
+            objects = doc().get_queryset().filter(pk__gte=low, pk__lt=high)
+            success, _ = doc().bulk(get_actions(doc, objects, index=index))
+            return success
+        finally:
+            # Each worker thread has its own database connection.
+            connections.close_all()
+
+    def catch_up(self, built, max_rounds=10):
+        """
+        Replay the logged changes into the built indices until there are none left.
+        Returns False if there still were after `max_rounds`.
+        """
+        for _ in range(max_rounds):
+            entries = take_entries(REBUILD_LOG_KEY)
+            if not entries:
+                return True
+            index_entries(entries, indices=built)
+            self.stdout.write(f"Replayed {len(entries)} changes.")
+        return False
+
+    def swap(self, doc, index):
+        alias = doc._index._name
+        actions = [{"add": {"index": index, "alias": alias}}]
+        if self.es.indices.exists_alias(name=alias):
+            for old in self.es.indices.get_alias(name=alias):
+                actions.insert(0, {"remove": {"index": old, "alias": alias}})
+        elif self.es.indices.exists(index=alias):
+            # A plain index left by `search_index --rebuild`, replaced in the same request.
+            actions.append({"remove_index": {"index": alias}})
+        self.es.indices.update_aliases(body={"actions": actions})
+        self.stdout.write(self.style.SUCCESS(f"{alias} now points to {index}."))
+
+    def delete_old_versions(self, alias, keep):
+        current = set(self.es.indices.get_alias(name=alias))
+        old = [name for _, name in sorted(self.get_versions(alias).items()) if name not in current]
+        for name in old[:max(len(old) - keep, 0)]:
+            self.es.indices.delete(index=name, ignore=[404])
+            self.stdout.write(f"Deleted {name}.")
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Product, update_search_vectors
+
+
+class Command(BaseCommand):
+    help = "Fill in the search vectors used by the Postgres search backend."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Recompute every vector, not only the missing ones.")
+
+    def handle(self, *args, **options):
+        products = Product._base_manager.all()
+        if not options["all"]:
+            products = products.filter(search_vector__isnull=True)
+        count = update_search_vectors(products)
+        self.stdout.write(f"Updated the search vectors of {count} products.")
@@ -1,12 +1,20 @@
 import os
 
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save, pre_save
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import connection, models, transaction
+from django.db.models import F, Q
+from django.db.models.signals import (m2m_changed, post_delete, post_init,
+                                      post_save, pre_delete, pre_save)
 from django.dispatch import receiver
+from django.utils import timezone
 from phonenumber_field.modelfields import PhoneNumberField
 from PIL import Image
 
+from main.caching import cache_tokens_valid_after, invalidate_tags
+from main.outbox import record_events
+
 CATEGORY_CHOICES = (
     "Stationary",
     "Movie Ticket",
@@ -16,9 +24,55 @@ CATEGORY_CHOICES = (
     "Other Utility",
 )
 
+# Text search configuration of Product.search_vector, see main.search.postgres.
+SEARCH_CONFIG = "english"
+
+
+class OutboxModel(models.Model):
+    """
+    Base of the models whose signals record OutboxEvents, so that a row and the events
+    about it are always saved in one transaction. This includes the models in the search
+    index, see main.indexing.QueuedSignalProcessor. Deletes and many-to-many changes
+    already send their signals inside a transaction.
+    """
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get("using"), savepoint=False):
+            super().save(*args, **kwargs)
+
+
+class OutboxEvent(models.Model):
+    """
+    Side effect of a write, recorded in the write's transaction and applied in batches by
+    main.tasks.drain_outbox, see main.outbox.
+    """
+    RATING = "rating"  # A profile was rated.
+    OFFER = "offer"  # An offer was made on a product.
+    REPORT = "report"  # A profile was reported.
+    SELLER = "seller"  # A seller's name or hostel changed.
+    INDEX = "index"  # An object in the search index changed.
+    KINDS = (
+        (RATING, "Rating"),
+        (OFFER, "Offer"),
+        (REPORT, "Report"),
+        (SELLER, "Seller"),
+        (INDEX, "Index"),
+    )
+
+    kind = models.CharField(choices=KINDS, max_length=10)
+    # The object the event is about, e.g. the rated profile.
+    model = models.CharField(max_length=100)
+    object_id = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Failed drains of the event, see main.outbox.drain_outbox.
+    attempts = models.PositiveSmallIntegerField(default=0)
+
 
 # Create your models here.
-class Profile(models.Model):
+class Profile(OutboxModel):
     # --- Hostel Choices ---
     HOSTEL_CHOICES = (
         ("SR", "SR Bhavan"),
@@ -45,47 +99,122 @@ class Profile(models.Model):
     avatar = models.ManyToManyField('Avatar', symmetrical=False, blank=True)
     hostel = models.CharField(choices=HOSTEL_CHOICES, max_length=2)
     contact_no = PhoneNumberField(blank=True, null=True, unique=True)
-    rating = models.DecimalField(max_digits=2, decimal_places=1, default=0)
+    # Aggregates of ratings_received, kept up to date by main.outbox.update_ratings.
+    rating_sum = models.IntegerField(default=0)
     num_ratings = models.IntegerField(default=0)
     email = models.EmailField()
     is_complete = models.BooleanField(default=False) # Field to signify if user has filled all required details in profile.
     permission_level = models.SmallIntegerField(choices=LEVELS, default=2)
+    # Claims of the user's tokens issued before this are not trusted, see main.tokens.
+    tokens_valid_after = models.DateTimeField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return f"Profile({self.user.username})"
 
+    @property
+    def rating(self):
+        if self.num_ratings == 0:
+            return 0
+        return round(self.rating_sum / self.num_ratings, 1)
+
+
+
+def permission_level_for_email(email):
+    """
+    Permission level of a new user with the given email.
+    BITSIAN -> SELLER
+    NON-BITSIAN -> BUYER
+    """
+    domain = email.rsplit("@", 1)[-1]
+    return Profile.SELLER if domain == "pilani.bits-pilani.ac.in" else Profile.BUYER
 
 
 @receiver(post_save, sender=User)
 def create_or_update_profile(sender, instance, created, **kwargs):
     """
-    When a new user is created, create a profile for it.
+    When a new user is created, create its profile and wishlist, with the profile's email
+    and permission level taken from the user's email.
     When the user is updated, update its profile.
     """
     if created:
-        Profile.objects.create(user=instance)
-        Wishlist.objects.create(profile=instance.profile)
-    instance.profile.save()
+        profile = Profile(user=instance)
+        if instance.email:
+            profile.email = instance.email
+            profile.permission_level = permission_level_for_email(instance.email)
+        profile.save(force_insert=True)
+        Wishlist.objects.create(profile=profile)
+    else:
+        instance.profile.save()
+
+# Profile fields stored in product documents, see main.documents.ProductDocument.
+SELLER_DOCUMENT_FIELDS = ("name", "hostel")
+
+
+def get_seller_fields(profile):
+    return {field: profile.__dict__.get(field) for field in SELLER_DOCUMENT_FIELDS}
+
+
+@receiver(post_init, sender=Profile)
+def remember_loaded_fields(sender, instance, **kwargs):
+    # Read __dict__ so deferred fields aren't loaded just for this.
+    instance._loaded_permission_level = instance.__dict__.get("permission_level")
+    instance._loaded_seller_fields = get_seller_fields(instance)
+
+
+@receiver(pre_save, sender=Profile)
+def check_permission_level(sender, instance, **kwargs):
+    loaded = instance._loaded_permission_level
+    instance._permission_level_changed = (
+        not instance._state.adding and loaded is not None and loaded != instance.permission_level
+    )
+    instance._loaded_permission_level = instance.permission_level
+
+
+def revoke_tokens(user_id):
+    """
+    Stop trusting the claims of the tokens issued to a user so far, see main.tokens.
+    """
+    now = timezone.now()
+    Profile.objects.filter(user_id=user_id).update(tokens_valid_after=now)
+    transaction.on_commit(lambda: cache_tokens_valid_after(user_id, now.timestamp()))
 
 
 @receiver(post_save, sender=Profile)
-def set_permission_level(sender, instance, created, **kwargs):
+def revoke_token_claims(sender, instance, **kwargs):
     """
-    When a new user is created, set its permission_level according to its email.
-    BITSIAN -> SELLER
-    NON-BITSIAN -> BUYER
+    Stop trusting the permission level in the user's tokens once it changes, so that
+    bans (see main.outbox.moderate_profiles) apply to them right away.
+    """
+    if instance._permission_level_changed:
+        revoke_tokens(instance.user_id)
+
+
+@receiver(post_save, sender=Profile)
+def reindex_seller_products(sender, instance, created, **kwargs):
+    """
+    Product documents store their seller's name and hostel, so reindex the seller's products
+    when either changes.
     """
-    if instance.email != "" and instance.permission_level is not None:
-        domain = instance.email.split('@')[1]
+    loaded, current = instance._loaded_seller_fields, get_seller_fields(instance)
+    changed = any(
+        loaded[field] is not None and current[field] != loaded[field] for field in SELLER_DOCUMENT_FIELDS
+    )
+    if not created and changed:
+        record_events(OutboxEvent.SELLER, Profile, [instance.pk])
+    instance._loaded_seller_fields = current
+
+
+@receiver(post_save, sender=User)
+def revoke_inactive_user_tokens(sender, instance, created, **kwargs):
+    if not created and not instance.is_active:
+        revoke_tokens(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def revoke_deleted_user_tokens(sender, instance, **kwargs):
+    # The profile is gone, so only the cached copy needs replacing.
+    transaction.on_commit(lambda: cache_tokens_valid_after(instance.pk, timezone.now().timestamp()))
 
-        # Bitsian or Non Bitsian
-        if domain == "pilani.bits-pilani.ac.in":
-            # Bitsians can be sellers
-            permission_level = Profile.SELLER
-        else:
-            # Non-bitsians can be buyers only.
-            permission_level = Profile.BUYER
-            instance.permission_level = permission_level
 
 @receiver(pre_save, sender=Profile)
 def update_is_complete(sender, instance, **kwargs):
@@ -107,7 +236,7 @@ class Avatar(models.Model):
         super().save(*args, **kwargs)
 
 
-class ProfileRating(models.Model):
+class ProfileRating(OutboxModel):
     rating_for = models.ForeignKey(
         Profile, related_name="ratings_received", on_delete=models.CASCADE
     )
@@ -120,14 +249,10 @@ class ProfileRating(models.Model):
 @receiver(post_save, sender=ProfileRating)
 def update_profile_rating(sender, instance, created, **kwargs):
     """
-    Update the average rating of a profile when a new rating is given to the profile.
+    Have the rating aggregates of the rated profile recomputed, see main.outbox.update_ratings.
     """
     if created:
-        profile = instance.rating_for
-        num_ratings = profile.num_ratings
-        profile.rating = (profile.rating * num_ratings + instance.rating) / (num_ratings + 1)
-        profile.num_ratings += 1
-        profile.save()
+        record_events(OutboxEvent.RATING, Profile, [instance.rating_for_id])
 
 
 class Category(models.Model):
@@ -150,11 +275,12 @@ class ProductManager(models.Manager):
     objects.all() -> Only visible and non-expired products
     """
     def get_queryset(self):
-        return super().get_queryset().filter(expired=False, visible=True)
+        # search_vector is only read by the database itself.
+        return super().get_queryset().filter(expired=False, visible=True).defer("search_vector")
 
 
 
-class Product(models.Model):
+class Product(OutboxModel):
     name = models.CharField(max_length=60)
     images = models.ManyToManyField('ImageModel', symmetrical=False, blank=True)
     seller = models.ForeignKey(
@@ -163,10 +289,12 @@ class Product(models.Model):
         on_delete=models.CASCADE,
         null=True,
         blank=True,
+        # Covered by the (seller, created_at) index below.
+        db_index=False,
     )
     expected_price = models.PositiveIntegerField(blank=False, null=False)
     description = models.CharField(max_length=300)
-    category = models.ForeignKey('Category', related_name="products", on_delete=models.SET_NULL, null=True)
+    category = models.ForeignKey('Category', related_name="products", on_delete=models.SET_NULL, null=True, db_index=False)
     is_ticket = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -178,8 +306,25 @@ class Product(models.Model):
     expired = models.BooleanField(default=False) # For expiring products after given expiry period.
     sold = models.BooleanField(default=False) # For marking a product as sold after deal is complete.
 
+    # Weighted name and description for the Postgres search backend, see update_search_vectors.
+    search_vector = SearchVectorField(null=True, editable=False)
+
     objects = ProductManager()
 
+    class Meta:
+        indexes = [
+            # Product.objects (visible, unexpired) in keyset order, see utils.PRODUCT_CURSOR_ORDERING.
+            models.Index(
+                fields=["created_at", "id"],
+                name="product_listing_idx",
+                condition=Q(expired=False, visible=True),
+            ),
+            # A seller's or category's products, newest first. Also serve the foreign keys' lookups.
+            models.Index(fields=["seller", "-created_at"], name="product_seller_idx"),
+            models.Index(fields=["category", "-created_at"], name="product_category_idx"),
+            GinIndex(fields=["search_vector"]),
+        ]
+
     def to_dict(self):
         return {
             "pk": self.pk,
@@ -197,6 +342,20 @@ class Product(models.Model):
         return self.name
 
 
+def update_search_vectors(queryset):
+    """
+    Recompute Product.search_vector for the products in `queryset`. A no-op on databases
+    other than Postgres, where the search backend falls back to substring matches.
+    """
+    if connection.vendor != "postgresql":
+        return 0
+    vector = (
+        SearchVector("name", weight="A", config=SEARCH_CONFIG)
+        + SearchVector("description", weight="B", config=SEARCH_CONFIG)
+    )
+    return queryset.update(search_vector=vector)
+
+
 class Wishlist(models.Model):
     """
     Model to save a user's wishlist. 
@@ -211,19 +370,94 @@ class ImageModel(models.Model):
     Utility model for product images and profile photos.
     """
     image = models.ImageField(upload_to="images/")
-    thumbnail = models.ImageField(upload_to="thumbs/")
+    # Uploads are stored once per content hash and shared by every product that uses them,
+    # see main.images.store_images.
+    sha256 = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    # Number of products using the image. Unreferenced images are deleted by main.tasks.collect_images.
+    ref_count = models.IntegerField(default=0)
+    unreferenced_at = models.DateTimeField(null=True, blank=True)
+    # Resized renditions without EXIF data, generated in the background by main.tasks.process_image.
+    thumbnail = models.ImageField(upload_to="thumbs/", blank=True)
+    medium = models.ImageField(upload_to="thumbs/", blank=True)
+    large = models.ImageField(upload_to="thumbs/", blank=True)
+
+    def get_url(self, size="large"):
+        """
+        URL of the rendition of the given size, or of the original if it hasn't been generated yet.
+        """
+        rendition = getattr(self, size, None) if size != "original" else None
+        return (rendition or self.image).url
+
+
+def update_image_references(image_ids, amount):
+    images = ImageModel.objects.filter(pk__in=image_ids)
+    if amount > 0:
+        images.update(ref_count=F("ref_count") + amount, unreferenced_at=None)
+    else:
+        images.update(ref_count=F("ref_count") + amount)
+        images.filter(ref_count__lte=0).update(unreferenced_at=timezone.now())
+
+
+@receiver(m2m_changed, sender=Product.images.through)
+def count_image_references(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep ImageModel.ref_count up to date as images are linked to and unlinked from products.
+    """
+    own, other = ("imagemodel_id", "product_id") if reverse else ("product_id", "imagemodel_id")
+    if action == "post_add":
+        # pk_set only holds the links that didn't exist yet.
+        changed, amount = pk_set, 1
+    elif action in ("pre_remove", "pre_clear"):
+        links = sender.objects.filter(**{own: instance.pk})
+        if action == "pre_remove":
+            links = links.filter(**{f"{other}__in": pk_set})
+        changed, amount = list(links.values_list(other, flat=True)), -1
+    else:
+        return
+
+    if not changed:
+        return
+    if reverse:
+        update_image_references([instance.pk], amount * len(changed))
+    else:
+        update_image_references(changed, amount)
+
+
+@receiver(pre_delete, sender=Product)
+def release_product_images(sender, instance, **kwargs):
+    """
+    Links deleted along with a product don't send m2m_changed.
+    """
+    through = Product.images.through
+    image_ids = list(through.objects.filter(product_id=instance.pk).values_list("imagemodel_id", flat=True))
+    if image_ids:
+        update_image_references(image_ids, -1)
 
-    # @receiver(pre_save)
-    # def resize_image(self,instance,**kwargs):
-    #     pass
 
+@receiver(post_delete, sender=ImageModel)
+def delete_image_files(sender, instance, **kwargs):
+    # Rows created before content addressing may share a file.
+    if ImageModel.objects.filter(image=instance.image.name).exists():
+        return
+    for field in ("image", "thumbnail", "medium", "large"):
+        f = getattr(instance, field)
+        if f:
+            f.delete(save=False)
 
-class ProductOffer(models.Model):
+
+class ProductOffer(OutboxModel):
     offerer = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name="offers")
-    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="offers")
+    # Covered by the unique constraint below.
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="offers", db_index=False)
     amount = models.IntegerField()
     message = models.CharField(max_length=400)
 
+    class Meta:
+        constraints = [
+            # One offer per buyer and product, see the CreateOffer mutation.
+            models.UniqueConstraint(fields=["product", "offerer"], name="unique_product_offer"),
+        ]
+
     def validate_offer_amount(self):
         """
         Check if offer amount is greater than product's base price
@@ -240,15 +474,43 @@ class ProductOffer(models.Model):
     def __str__(self):
         return f"ProductOffer({self.product.name}, {self.offerer.name}, {self.amount})"
 
+def get_searched_text(instance):
+    # Read __dict__ so deferred fields aren't loaded just for this.
+    return instance.__dict__.get("name"), instance.__dict__.get("description")
+
+
+@receiver(post_init, sender=Product)
+def remember_searched_text(sender, instance, **kwargs):
+    instance._loaded_searched_text = get_searched_text(instance)
+
+
+@receiver(post_save, sender=Product)
+def update_search_vector(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Recompute the product's search vector when its name or description changed.
+    """
+    if update_fields is not None and not {"name", "description"}.intersection(update_fields):
+        return
+    text = get_searched_text(instance)
+    if created or text != instance._loaded_searched_text:
+        update_search_vectors(Product._base_manager.filter(pk=instance.pk))
+    instance._loaded_searched_text = text
+
+
+@receiver(m2m_changed, sender=Wishlist.products.through)
+@receiver(m2m_changed, sender=Product.images.through)
+def invalidate_product_relations(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        invalidate_tags(Product._meta.label_lower)
+
+
 @receiver(post_save, sender=ProductOffer)
 def update_product_offers(sender, instance, created, **kwargs):
     """
-    Update the number of offers of a product when a new offer is made.
+    Have the offers of the product recounted, see main.outbox.update_offer_counts.
     """
     if created:
-        product = instance.product
-        product.num_offers += 1
-        product.save()
+        record_events(OutboxEvent.OFFER, Product, [instance.product_id])
 
 
 class ProductQnA(models.Model):
@@ -273,7 +535,7 @@ class ProductQnA(models.Model):
         verbose_name_plural = "Products QnA"
 
 
-class UserReport(models.Model):
+class UserReport(OutboxModel):
     """
     Model for handling reporting of users by other users.
     Reports can be categorized into three broad categories mentioned below.
@@ -289,13 +551,30 @@ class UserReport(models.Model):
 
 
 @receiver(post_save, sender=UserReport)
-def moderate_profile(sender, instance, **kwargs):
+def moderate_profile(sender, instance, created, **kwargs):
+    """
+    Have the reported user banned if they've been reported too often, see main.outbox.moderate_profiles.
+    """
+    if created:
+        record_events(OutboxEvent.REPORT, Profile, [instance.reported_user_id])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=ProductOffer)
+@receiver(post_delete, sender=ProductOffer)
+@receiver(post_save, sender=ProductQnA)
+@receiver(post_delete, sender=ProductQnA)
+@receiver(post_save, sender=UserReport)
+@receiver(post_delete, sender=UserReport)
+@receiver(post_save, sender=ImageModel)
+@receiver(post_delete, sender=ImageModel)
+def invalidate_cache_tags(sender, **kwargs):
     """
-    Ban a user after 5 reports.
+    Invalidate the paginator counts and GraphQL responses cached for a model when one of its rows changes.
     """
-    # TODO: Implement mechanism to notify moderators.
-    MAX_ALLOWED_REPORTS = 5
-    profile = instance.reported_user
-    if profile.reports.count() > MAX_ALLOWED_REPORTS:
-        profile.permission_level = Profile.BANNED
-        profile.save()
+    invalidate_tags(sender._meta.label_lower)
@@ -0,0 +1,158 @@
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from main import indexing
+from main.caching import invalidate_tags
+
+log = logging.getLogger("main")
+
+# A profile is banned once it has been reported more than this many times.
+MAX_ALLOWED_REPORTS = 5
+
+
+def record_events(kind, model, pks):
+    """
+    Record events of one kind about the objects of `model` with the given primary keys,
+    with a single INSERT into the outbox. Called from model signals, so the events are
+    saved in the transaction of the write that caused them (see models.OutboxModel).
+    """
+    from main.models import OutboxEvent
+
+    label = model._meta.label_lower
+    OutboxEvent.objects.bulk_create([OutboxEvent(kind=kind, model=label, object_id=pk) for pk in pks])
+
+
+def update_ratings(profile_ids):
+    """
+    Recompute the rating aggregates of the rated profiles.
+    """
+    from main.models import Profile, ProfileRating
+
+    aggregates = {
+        row["rating_for"]: (row["total"], row["count"])
+        for row in ProfileRating.objects.filter(rating_for__in=profile_ids)
+        .values("rating_for")
+        .annotate(total=Sum("rating"), count=Count("id"))
+    }
+    profiles = []
+    for pk in profile_ids:
+        rating_sum, num_ratings = aggregates.get(pk, (0, 0))
+        profiles.append(Profile(pk=pk, rating_sum=rating_sum, num_ratings=num_ratings))
+    Profile.objects.bulk_update(profiles, ["rating_sum", "num_ratings"])
+    invalidate_tags(Profile._meta.label_lower)
+
+
+def update_offer_counts(product_ids):
+    """
+    Recount the offers of the products offered on.
+    """
+    from main.models import Product, ProductOffer
+
+    counts = dict(
+        ProductOffer.objects.filter(product__in=product_ids)
+        .values_list("product")
+        .annotate(count=Count("id"))
+    )
+    products = [Product(pk=pk, num_offers=counts.get(pk, 0)) for pk in product_ids]
+    Product._base_manager.bulk_update(products, ["num_offers"])
+    invalidate_tags(Product._meta.label_lower)
+
+
+def moderate_profiles(profile_ids):
+    """
+    Ban the reported profiles with more than MAX_ALLOWED_REPORTS reports.
+    """
+    from main.models import Profile
+
+    profiles = (
+        Profile.objects.filter(pk__in=profile_ids)
+        .exclude(permission_level=Profile.BANNED)
+        .annotate(num_reports=Count("reports"))
+        .filter(num_reports__gt=MAX_ALLOWED_REPORTS)
+    )
+    for profile in profiles:
+        profile.permission_level = Profile.BANNED
+        # Saved one by one so the user's tokens are revoked, see models.revoke_token_claims.
+        profile.save(update_fields=["permission_level"])
+
+
+def reindex_seller_products(profile_ids):
+    """
+    Product documents store the name and hostel of their seller, see main.documents.
+    """
+    from main.models import Product
+
+    product_ids = Product._base_manager.filter(seller__in=profile_ids).values_list("id", flat=True)
+    indexing.queue_objects(Product, list(product_ids))
+
+
+def queue_for_indexing(objects):
+    """
+    Hand the changed objects over to the search index queue, see main.indexing.
+    """
+    indexing.queue_for_indexing([f"{label}:{pk}" for label, pk in objects])
+
+
+def drain_outbox():
+    """
+    Apply the oldest OUTBOX_BATCH_SIZE events, grouped by kind, and delete them in the same
+    transaction. Each kind is applied in its own savepoint: if it fails, the error is logged
+    and its events stay in the outbox with one more attempt, while the other kinds go through.
+    Events that failed OUTBOX_MAX_ATTEMPTS times are left aside.
+    Events are taken with SKIP LOCKED, so concurrent drains don't apply the same events.
+    Returns the number of events applied.
+    """
+    from main import tasks
+    from main.models import OutboxEvent
+
+    # Applied in this order, so that e.g. products are recounted before being reindexed.
+    handlers = [
+        (OutboxEvent.RATING, update_ratings),
+        (OutboxEvent.OFFER, update_offer_counts),
+        (OutboxEvent.REPORT, moderate_profiles),
+        (OutboxEvent.SELLER, reindex_seller_products),
+        (OutboxEvent.INDEX, queue_for_indexing),
+    ]
+
+    batch_size = settings.OUTBOX_BATCH_SIZE
+    with transaction.atomic():
+        events = list(
+            OutboxEvent.objects.select_for_update(skip_locked=True)
+            .filter(attempts__lt=settings.OUTBOX_MAX_ATTEMPTS)
+            .order_by("id")
+            .values_list("id", "kind", "model", "object_id")[:batch_size]
+        )
+        if not events:
+            return 0
+
+        event_ids = defaultdict(list)
+        objects = defaultdict(set)
+        for event_id, kind, label, object_id in events:
+            event_ids[kind].append(event_id)
+            # Index events name objects of any model, the others name one model per kind.
+            objects[kind].add((label, object_id) if kind == OutboxEvent.INDEX else object_id)
+
+        failed = []
+        for kind, handler in handlers:
+            if not objects[kind]:
+                continue
+            try:
+                with transaction.atomic():
+                    handler(objects[kind])
+            except Exception:
+                log.exception("Applying %d %s events from the outbox failed", len(event_ids[kind]), kind)
+                failed.extend(event_ids[kind])
+
+        failed_ids = set(failed)
+        applied = [event_id for event_id, *_ in events if event_id not in failed_ids]
+        OutboxEvent.objects.filter(id__in=applied).delete()
+        OutboxEvent.objects.filter(id__in=failed).update(attempts=F("attempts") + 1)
+
+    if len(events) == batch_size:
+        # More events are probably waiting.
+        tasks.drain_outbox.delay()
+    return len(applied)
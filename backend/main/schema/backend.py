@@ -0,0 +1,91 @@
+import hashlib
+from collections import OrderedDict
+from functools import partial
+from threading import Lock
+
+from graphql.backend.base import GraphQLDocument
+from graphql.backend.core import GraphQLCoreBackend
+from graphql.execution import ExecutionResult, execute
+from graphql.language.base import parse
+from graphql.validation import validate
+
+
+def query_hash(query):
+    """
+    sha256 of a query document, as sent by clients using persisted queries.
+    """
+    return hashlib.sha256(query.encode("utf8")).hexdigest()
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self.items[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        return {"size": len(self), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+class ValidatedDocumentBackend(GraphQLCoreBackend):
+    """
+    Backend that parses and validates every distinct query document once per worker and
+    keeps the result in an LRU keyed by the document's sha256.
+    It is installed as the default graphql-core backend in marketplace.schema.
+    """
+
+    def __init__(self, max_size=256, executor=None):
+        super().__init__(executor=executor)
+        self.documents = LRUCache(max_size)
+
+    def get_document(self, schema, sha256_hash):
+        """
+        Return the cached document with the given hash, or None.
+        """
+        return self.documents.get((schema, sha256_hash))
+
+    def document_from_string(self, schema, document_string):
+        key = (schema, query_hash(document_string))
+        document = self.documents.get(key)
+        if document is None:
+            document = self.build_document(schema, document_string)
+            self.documents.set(key, document)
+        return document
+
+    def build_document(self, schema, document_string):
+        document_ast = parse(document_string)
+        validation_errors = validate(schema, document_ast)
+        if validation_errors:
+            def execute_document(*args, **kwargs):
+                return ExecutionResult(errors=validation_errors, invalid=True)
+        else:
+            execute_document = partial(execute, schema, document_ast, **self.execute_params)
+
+        return GraphQLDocument(
+            schema=schema,
+            document_string=document_string,
+            document_ast=document_ast,
+            execute=execute_document,
+        )
@@ -26,3 +26,12 @@ class UserReportInput(graphene.InputObjectType):
 class UploadImageInput(graphene.InputObjectType):
     product_id = graphene.Int()
 
+
+class ProductSearchFilter(graphene.InputObjectType):
+    categories = graphene.List(graphene.String)
+    min_price = graphene.Int()
+    max_price = graphene.Int()
+    is_negotiable = graphene.Boolean()
+    is_ticket = graphene.Boolean()
+    sold = graphene.Boolean()
+    hostel = graphene.String()
@@ -0,0 +1,172 @@
+from collections import defaultdict
+
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from main import models
+
+
+class RelatedListLoader(DataLoader):
+    """
+    Loads the related rows of many parent objects with a single `IN (...)` query.
+    Subclasses set the queryset to load from and the field holding the parent's key.
+    """
+    key_field = None
+
+    def get_queryset(self):
+        raise NotImplementedError
+
+    def batch_load_fn(self, keys):
+        grouped = defaultdict(list)
+        qs = self.get_queryset().filter(**{f"{self.key_field}__in": keys})
+        for obj in qs:
+            grouped[getattr(obj, self.key_field)].append(obj)
+        return Promise.resolve([grouped.get(key, []) for key in keys])
+
+
+class ObjectLoader(DataLoader):
+    """
+    Loads objects by primary key with a single `IN (...)` query.
+    """
+    model = None
+
+    def batch_load_fn(self, keys):
+        objects = self.model._base_manager.in_bulk(keys)
+        return Promise.resolve([objects.get(key) for key in keys])
+
+
+class ProductImagesLoader(DataLoader):
+    def batch_load_fn(self, keys):
+        grouped = defaultdict(list)
+        through = models.Product.images.through.objects.filter(product_id__in=keys).select_related('imagemodel')
+        for row in through:
+            grouped[row.product_id].append(row.imagemodel)
+        return Promise.resolve([grouped.get(key, []) for key in keys])
+
+
+class ProductOffersLoader(RelatedListLoader):
+    key_field = 'product_id'
+
+    def get_queryset(self):
+        return models.ProductOffer.objects.all()
+
+
+class ProductQuestionsLoader(RelatedListLoader):
+    key_field = 'product_id'
+
+    def get_queryset(self):
+        return models.ProductQnA.objects.all()
+
+
+class ProfileProductsLoader(RelatedListLoader):
+    key_field = 'seller_id'
+
+    def get_queryset(self):
+        return models.Product.objects.all()
+
+
+class ProfileOffersLoader(RelatedListLoader):
+    key_field = 'offerer_id'
+
+    def get_queryset(self):
+        return models.ProductOffer.objects.all()
+
+
+class ProfileReportsLoader(RelatedListLoader):
+    key_field = 'reported_user_id'
+
+    def get_queryset(self):
+        return models.UserReport.objects.all()
+
+
+class CategoryProductsLoader(RelatedListLoader):
+    key_field = 'category_id'
+
+    def get_queryset(self):
+        return models.Product.objects.all()
+
+
+class ProfileLoader(ObjectLoader):
+    model = models.Profile
+
+
+class CategoryLoader(ObjectLoader):
+    model = models.Category
+
+
+class Loaders:
+    """
+    One set of loaders per request, so results are batched and cached only for the
+    lifetime of that request.
+    """
+    def __init__(self):
+        self.product_images = ProductImagesLoader()
+        self.product_offers = ProductOffersLoader()
+        self.product_questions = ProductQuestionsLoader()
+        self.profile_products = ProfileProductsLoader()
+        self.profile_offers = ProfileOffersLoader()
+        self.profile_reports = ProfileReportsLoader()
+        self.category_products = CategoryProductsLoader()
+        self.profile = ProfileLoader()
+        self.category = CategoryLoader()
+
+
+def prefetched(instance, name):
+    """
+    Return the rows of `name` already fetched with prefetch_related, or None.
+    """
+    cache = getattr(instance, '_prefetched_objects_cache', {})
+    if name in cache:
+        return list(cache[name])
+    return None
+
+
+def load_many(info, instance, name, loader_name):
+    """
+    Resolve a reverse/M2M relation from the prefetch cache if possible, else batch it.
+    """
+    rows = prefetched(instance, name)
+    if rows is not None:
+        return rows
+    return getattr(get_loaders(info), loader_name).load(instance.pk)
+
+
+def load_one(info, instance, name, loader_name):
+    """
+    Resolve a foreign key from the select_related cache if possible, else batch it.
+    """
+    field = instance._meta.get_field(name)
+    if field.is_cached(instance):
+        return getattr(instance, name)
+    key = getattr(instance, field.attname)
+    if key is None:
+        return None
+    return getattr(get_loaders(info), loader_name).load(key)
+
+
+def get_wishlist_ids(info):
+    """
+    Ids of the products in the requesting user's wishlist, loaded once per request.
+    """
+    context = info.context
+    if getattr(context, 'wishlist_ids', None) is None:
+        user = getattr(context, 'user', None)
+        profile = getattr(user, 'profile', None) if user is not None and user.is_authenticated else None
+        context.wishlist_ids = set()
+        if profile is not None:
+            context.wishlist_ids = set(
+                models.Wishlist.products.through.objects.filter(wishlist__profile_id=profile.id)
+                .values_list('product_id', flat=True)
+            )
+    return context.wishlist_ids
+
+
+def get_loaders(info):
+    """
+    Return the loaders attached to the request in `info.context`, creating them on first use.
+    """
+    loaders = getattr(info.context, 'loaders', None)
+    if loaders is None:
+        loaders = Loaders()
+        info.context.loaders = loaders
+    return loaders
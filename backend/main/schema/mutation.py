@@ -2,6 +2,7 @@ import logging
 
 import graphene
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, transaction
 from graphql_jwt.decorators import login_required, user_passes_test
 from graphene_file_upload.scalars import Upload
 
@@ -10,6 +11,7 @@ from main.schema import utils
 from main.schema.inputs import (ProductInput, ProductOfferInput,
                                 ProfileUpdateInput, UserReportInput,
                                 UploadImageInput)
+from main.schema.loaders import get_wishlist_ids
 from main.schema.types import (Product, ProductOffer, Profile, UserReport,
                                Wishlist)
 
@@ -65,7 +67,7 @@ class UpdateProduct(MutationPayload, graphene.Mutation):
             errors.append(f"Product with primary key {id} does not exist.")
             return UpdateProduct(errors=errors, product=None)
 
-        if product.seller != info.context.user.profile:
+        if product.seller_id != info.context.user.profile.id:
             errors.append("You are not allowed to perform this action.")
             return UpdateProduct(errors=errors, product=None)
         
@@ -119,14 +121,19 @@ class UpdateWishlist(MutationPayload, graphene.Mutation):
         except ObjectDoesNotExist:
             errors.append(f"Product requested to add, not found ")
             return UpdateWishlist(errors=errors, wishlist=None)
-        if(product.seller == info.context.user.profile):
+        profile = info.context.user.profile
+        if(product.seller_id == profile.id):
             errors.append(f"User can't add his product to wishlist.")
             return UpdateWishlist(errors=errors, wishlist=None)
-        wishlist = info.context.user.profile.wishlist
-        if product in wishlist.products.all():
+        wishlist = profile.wishlist
+        # Updated in place, so the payload's inWishlist fields stay right.
+        wishlist_ids = get_wishlist_ids(info)
+        if product.id in wishlist_ids:
             wishlist.products.remove(product)
+            wishlist_ids.discard(product.id)
         else:
             wishlist.products.add(product)
+            wishlist_ids.add(product.id)
 
         return UpdateWishlist(errors=errors, wishlist=wishlist)
 
@@ -149,33 +156,31 @@ class CreateOffer(MutationPayload, graphene.Mutation):
             return CreateOffer(errors=errors, offer=None)
 
         profile = info.context.user.profile
-        if(product.seller == profile):
+        if(product.seller_id == profile.id):
             errors.append(f"User cannot offer on their own product")
             return CreateOffer(errors=errors, offer=None)
 
-        try:
-            previous_offer = product.offers.get(offerer=profile)
-        except ObjectDoesNotExist:
-            previous_offer = None
-        
-        if (previous_offer):
+        if product.offers.filter(offerer=profile).exists():
             errors.append(f"You cannot create multiple offers")
             return CreateOffer(errors=errors, offer=None)
 
         if (not product.is_negotiable):
-            message = input['message'] 
-            offer = utils.create_offer(profile, product, amount = product.expected_price, message = message)
-            viewlog.debug(f"New Offer: {offer.to_dict()}")
+            kwargs = {'amount': product.expected_price, 'message': input['message']}
+        else:
+            try:
+                assert input['amount'] != None
+            except:
+                errors.append(f"Missing argument 'amount'")
+                return CreateOffer(errors=errors, offer=None)
+            kwargs = input.__dict__
 
-            return CreateOffer(errors=errors, offer=offer)
-        
         try:
-            assert input['amount'] != None
-        except:
-            errors.append(f"Missing argument 'amount'")
+            with transaction.atomic():
+                offer = utils.create_offer(profile, product, **kwargs)
+        except IntegrityError:
+            # A concurrent request made an offer first, see ProductOffer.Meta.constraints.
+            errors.append(f"You cannot create multiple offers")
             return CreateOffer(errors=errors, offer=None)
-
-        offer = utils.create_offer(profile, product, **input.__dict__)
         viewlog.debug(f"New Offer: {offer.to_dict()}")
 
         return CreateOffer(errors=errors, offer=offer)
@@ -216,13 +221,13 @@ class UploadImage(MutationPayload, graphene.Mutation):
             errors.append(f"Product with primary key {id} does not exist.")
             return UploadImage(errors=errors, product=None)
 
-        if product.seller != info.context.user.profile:
+        if product.seller_id != info.context.user.profile.id:
             errors.append("You are not allowed to perform this action.")
             return UploadImage(errors=errors, product=None)
 
-        files = info.context.FILES
+        files = [f for _, uploads in info.context.FILES.lists() for f in uploads]
 
-        product = utils.add_images_to_product(files, id)
+        product = utils.add_images_to_product(product, files)
         viewlog.debug(f"Product created with details : {product.to_dict()}")
 
         return UploadImage(errors=errors,product=product)
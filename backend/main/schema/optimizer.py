@@ -0,0 +1,205 @@
+from graphql.language import ast
+
+# How each GraphQL field maps onto the ORM.
+# COLUMN fields are plain columns (or a tuple of the columns they are computed from), SELECT fields are foreign keys that can be joined
+# with select_related and PREFETCH fields are reverse/M2M relations for prefetch_related.
+COLUMN = 'column'
+SELECT = 'select'
+PREFETCH = 'prefetch'
+
+FIELD_MAP = {
+    'Product': {
+        'id': (COLUMN, 'id', None),
+        'name': (COLUMN, 'name', None),
+        'expectedPrice': (COLUMN, 'expected_price', None),
+        'description': (COLUMN, 'description', None),
+        'visible': (COLUMN, 'visible', None),
+        'sold': (COLUMN, 'sold', None),
+        'isNegotiable': (COLUMN, 'is_negotiable', None),
+        'createdAt': (COLUMN, 'created_at', None),
+        'inWishlist': (COLUMN, 'id', None),
+        'seller': (SELECT, 'seller', 'Profile'),
+        'category': (SELECT, 'category', 'Category'),
+        'images': (PREFETCH, 'images', None),
+        'offers': (PREFETCH, 'offers', 'ProductOffer'),
+        'questions': (PREFETCH, 'questions', 'ProductQnA'),
+    },
+    'Profile': {
+        'id': (COLUMN, 'id', None),
+        'name': (COLUMN, 'name', None),
+        'contactNo': (COLUMN, 'contact_no', None),
+        'rating': (COLUMN, ('rating_sum', 'num_ratings'), None),
+        'email': (COLUMN, 'email', None),
+        'hostel': (COLUMN, 'hostel', None),
+        'username': (SELECT, 'user', None),
+        'avatar': (PREFETCH, 'avatar', None),
+        'products': (PREFETCH, 'products', 'Product'),
+        'offers': (PREFETCH, 'offers', 'ProductOffer'),
+        'reports': (PREFETCH, 'reports', 'UserReport'),
+    },
+    'Category': {
+        'name': (COLUMN, 'name', None),
+        'products': (PREFETCH, 'products', 'Product'),
+    },
+    'ProductOffer': {
+        'amount': (COLUMN, 'amount', None),
+        'message': (COLUMN, 'message', None),
+        'offerer': (SELECT, 'offerer', 'Profile'),
+        'product': (SELECT, 'product', 'Product'),
+    },
+    'ProductQnA': {
+        'question': (COLUMN, 'question', None),
+        'answer': (COLUMN, 'answer', None),
+        'isAnswered': (COLUMN, 'is_answered', None),
+        'product': (SELECT, 'product', 'Product'),
+        'askedBy': (SELECT, 'asked_by', 'Profile'),
+    },
+    'UserReport': {
+        'category': (COLUMN, 'category', None),
+        'reportedUser': (SELECT, 'reported_user', 'Profile'),
+        'reportedBy': (SELECT, 'reported_by', 'Profile'),
+    },
+}
+
+
+# Fields of search results that can be built from ProductDocument's _source, with their child type.
+SOURCE_FIELDS = {
+    'Product': {
+        'id': None,
+        'name': None,
+        'expectedPrice': None,
+        'description': None,
+        'visible': None,
+        'sold': None,
+        'isNegotiable': None,
+        'createdAt': None,
+        'images': None,
+        'inWishlist': None,
+        'seller': 'Profile',
+        'category': 'Category',
+    },
+    'Profile': {
+        'id': None,
+        'name': None,
+    },
+    'Category': {
+        'name': None,
+    },
+}
+
+
+class QueryPlan:
+    def __init__(self, only=()):
+        self.only = {'id', *only}
+        self.only_complete = True
+        self.select_related = set()
+        self.prefetch_related = set()
+
+    def apply(self, qs):
+        if self.select_related:
+            qs = qs.select_related(*sorted(self.select_related))
+        if self.prefetch_related:
+            qs = qs.prefetch_related(*sorted(self.prefetch_related))
+        if self.only_complete:
+            qs = qs.only(*sorted(self.only))
+        return qs
+
+
+def iter_fields(selection_set, info):
+    """
+    Yield the field nodes of a selection set, expanding fragments.
+    """
+    if selection_set is None:
+        return
+    for selection in selection_set.selections:
+        if isinstance(selection, ast.Field):
+            yield selection
+        elif isinstance(selection, ast.FragmentSpread):
+            fragment = info.fragments[selection.name.value]
+            yield from iter_fields(fragment.selection_set, info)
+        elif isinstance(selection, ast.InlineFragment):
+            yield from iter_fields(selection.selection_set, info)
+
+
+def iter_selection_sets(info, path):
+    """
+    Yield the selection sets found by following the field names in `path` from the resolved field.
+    """
+    for field_ast in info.field_asts:
+        selection_sets = [field_ast.selection_set]
+        for name in path:
+            selection_sets = [
+                field.selection_set
+                for selection_set in selection_sets
+                for field in iter_fields(selection_set, info)
+                if field.name.value == name
+            ]
+        yield from selection_sets
+
+
+def build_plan(plan, selection_set, type_name, info, prefix='', via_prefetch=False):
+    is_root = prefix == ''
+    field_map = FIELD_MAP[type_name]
+
+    for field in iter_fields(selection_set, info):
+        name = field.name.value
+        if name == '__typename':
+            continue
+
+        try:
+            kind, orm_name, child_type = field_map[name]
+        except KeyError:
+            # Unknown fields may read any column, so don't defer anything.
+            if is_root:
+                plan.only_complete = False
+            continue
+
+        if kind == COLUMN:
+            if is_root:
+                plan.only.update(orm_name if isinstance(orm_name, tuple) else (orm_name,))
+            continue
+
+        if is_root and kind == SELECT:
+            plan.only.add(orm_name)
+
+        path = prefix + orm_name
+        nested_via_prefetch = via_prefetch or kind == PREFETCH
+        if nested_via_prefetch:
+            plan.prefetch_related.add(path)
+        else:
+            plan.select_related.add(path)
+
+        if child_type is not None:
+            build_plan(plan, field.selection_set, child_type, info, path + '__', nested_via_prefetch)
+
+
+def optimize_queryset(qs, info, type_name, path=(), only=()):
+    """
+    Apply select_related/prefetch_related/only to `qs` for the fields the client selected.
+    `path` names the fields between the resolved field and the objects of `qs`,
+    e.g. ('objects',) for paginated types. Columns in `only` are always loaded.
+    """
+    plan = QueryPlan(only)
+    for selection_set in iter_selection_sets(info, path):
+        build_plan(plan, selection_set, type_name, info)
+    return plan.apply(qs)
+
+
+def selects_only(info, type_name, available, path=()):
+    """
+    Whether the client selected nothing but the fields in `available` (a map like SOURCE_FIELDS)
+    below `path`.
+    """
+    def check(selection_set, type_name):
+        for field in iter_fields(selection_set, info):
+            name = field.name.value
+            if name == '__typename':
+                continue
+            if name not in available[type_name]:
+                return False
+            child_type = available[type_name][name]
+            if child_type is not None and not check(field.selection_set, child_type):
+                return False
+        return True
+
+    return all(check(selection_set, type_name) for selection_set in iter_selection_sets(info, path))
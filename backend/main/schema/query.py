@@ -2,12 +2,13 @@ import graphene
 from django.core.exceptions import ObjectDoesNotExist
 from graphql_jwt.decorators import login_required
 
-from main import models
+from main import models, search
 from main.schema import utils
+from main.schema.inputs import ProductSearchFilter
+from main.schema.optimizer import SOURCE_FIELDS, optimize_queryset, selects_only
 from main.schema.types import (Category, Product, ProductOffer,
-                               PaginatedProducts, Profile, UserReport, PaginatedProfiles)
-
-from main.documents import ProductDocument
+                               PaginatedProducts, Profile, UserReport, PaginatedProfiles,
+                               ProductSearchResults, ProductSuggestion)
 
 
 class Query:
@@ -18,11 +19,16 @@ class Query:
     profile = graphene.Field(Profile, id=graphene.Int(), username=graphene.String(), email=graphene.String())
     my_profile = graphene.Field(Profile)
     product_offer = graphene.List(ProductOffer, id=graphene.Int())
-    wishlist = graphene.Field(PaginatedProducts, page=graphene.Int(), pagesize=graphene.Int())
-    products = graphene.Field(PaginatedProducts, page=graphene.Int(), pagesize=graphene.Int())
-    profiles = graphene.Field(PaginatedProfiles, page=graphene.Int(), pagesize=graphene.Int())
+    # Omit `page` to paginate with cursors: pass the previous page's endCursor as `after`
+    # (or startCursor as `before`) to seek to the next page without COUNT(*)/OFFSET.
+    wishlist = graphene.Field(PaginatedProducts, page=graphene.Int(), pagesize=graphene.Int(), after=graphene.String(), before=graphene.String())
+    # approximateCount trades the exact `pages` for a planner estimate, for clients that don't need it.
+    products = graphene.Field(PaginatedProducts, page=graphene.Int(), pagesize=graphene.Int(), after=graphene.String(), before=graphene.String(), approximate_count=graphene.Boolean())
+    profiles = graphene.Field(PaginatedProfiles, page=graphene.Int(), pagesize=graphene.Int(), after=graphene.String(), before=graphene.String(), approximate_count=graphene.Boolean())
 
-    search_products = graphene.Field(PaginatedProducts, page=graphene.Int(), pagesize=graphene.Int(), querystring=graphene.String())
+    search_products = graphene.Field(ProductSearchResults, page=graphene.Int(), pagesize=graphene.Int(), querystring=graphene.String(), filters=ProductSearchFilter(), after=graphene.String(), before=graphene.String())
+    # Search-as-you-type: only ids and names, for the search box.
+    suggest_products = graphene.List(ProductSuggestion, prefix=graphene.String(required=True), limit=graphene.Int())
 
     @login_required
     def resolve_all_categories(self, info, **kwargs):
@@ -30,7 +36,7 @@ class Query:
 
     @login_required
     def resolve_all_profiles(self, info, **kwargs):
-        return models.Profile.objects.all()
+        return optimize_queryset(models.Profile.objects.all(), info, 'Profile')
 
     @login_required
     def resolve_category(self, info, **kwargs):
@@ -74,7 +80,7 @@ class Query:
 
     # profile.wishlist.products.all()
     @login_required
-    def resolve_wishlist(self, info, page, pagesize):
+    def resolve_wishlist(self, info, pagesize, page=None, after=None, before=None):
         profile = info.context.user.profile
 
         if profile is None:
@@ -82,7 +88,8 @@ class Query:
         
         page_size = pagesize
         qs = profile.wishlist.products.all()
-        return utils.get_paginator(qs, page_size, page, PaginatedProducts)
+        qs = optimize_queryset(qs, info, 'Product', path=('objects',), only=utils.PRODUCT_CURSOR_ORDERING)
+        return utils.paginate(qs, page_size, page, PaginatedProducts, utils.PRODUCT_CURSOR_ORDERING, after=after, before=before)
         
     @login_required
     def resolve_product_offer(self, info, **kwargs):
@@ -97,28 +104,49 @@ class Query:
         return None
 
     @login_required
-    def resolve_products(self, info, page, pagesize):
+    def resolve_products(self, info, pagesize, page=None, after=None, before=None, approximate_count=False):
         page_size = pagesize
         qs = models.Product.objects.all().order_by("created_at")
-        return utils.get_paginator(qs, page_size, page, PaginatedProducts)
+        qs = optimize_queryset(qs, info, 'Product', path=('objects',), only=utils.PRODUCT_CURSOR_ORDERING)
+        return utils.paginate(qs, page_size, page, PaginatedProducts, utils.PRODUCT_CURSOR_ORDERING, after=after, before=before, approximate=approximate_count)
 
     @login_required
     def resolve_my_profile(self, info, **kwargs):
+        # The user's profile may only hold what their token carried, see main.tokens.
         profile = info.context.user.profile
-        return profile
+        return optimize_queryset(models.Profile.objects.filter(pk=profile.pk), info, 'Profile').first()
 
     @login_required
-    def resolve_search_products(self, info, page, pagesize, **kwargs):
-        querystring = kwargs.get('querystring')
-        hits = ProductDocument.search().query("multi_match", fields=['name', 'description'],  query=querystring)
-        print(hits)
-        qs = hits.to_queryset()
-        page_size = pagesize
-        return utils.get_paginator(qs, page_size, page, PaginatedProducts)
+    def resolve_suggest_products(self, info, prefix, limit=5):
+        return search.suggest_products(prefix, limit)
+
+    @login_required
+    def resolve_search_products(self, info, pagesize, page=None, after=None, before=None, querystring=None, filters=None):
+        results = search.search_products(querystring, filters or {}, pagesize, page=page, after=after, before=before)
+        if results.products is not None and selects_only(info, 'Product', SOURCE_FIELDS, path=('objects',)):
+            # Everything the client asked for is in the index.
+            objects = results.products
+        else:
+            qs = models.Product.objects.filter(pk__in=results.ids)
+            products = optimize_queryset(qs, info, 'Product', path=('objects',)).in_bulk()
+            # Keep the order of the hits. Products hidden since they were last indexed are left out.
+            objects = [products[pk] for pk in results.ids if pk in products]
+        return ProductSearchResults(
+            objects=objects,
+            total=results.total,
+            facets=results.facets,
+            page=results.page,
+            pages=results.pages,
+            has_next=results.has_next,
+            has_prev=results.has_prev,
+            start_cursor=results.start_cursor,
+            end_cursor=results.end_cursor,
+        )
 
     @login_required
-    def resolve_profiles(self, info, page, pagesize):
+    def resolve_profiles(self, info, pagesize, page=None, after=None, before=None, approximate_count=False):
         page_size = pagesize
-        qs = models.Profile.objects.all()
-        return utils.get_paginator(qs, page_size, page, PaginatedProfiles)
+        qs = models.Profile.objects.all().order_by("id")
+        qs = optimize_queryset(qs, info, 'Profile', path=('objects',))
+        return utils.paginate(qs, page_size, page, PaginatedProfiles, utils.PROFILE_CURSOR_ORDERING, after=after, before=before, approximate=approximate_count)
 
@@ -1,7 +1,9 @@
 import graphene
 from graphene_django.types import DjangoObjectType, ObjectType
+from promise import Promise
 
 from main import models
+from main.schema.loaders import get_wishlist_ids, load_many, load_one, prefetched
 
 
 class ProductOffer(DjangoObjectType):
@@ -9,16 +11,43 @@ class ProductOffer(DjangoObjectType):
         model = models.ProductOffer
         fields = ['offerer', 'product', 'amount', 'message']
 
+    @staticmethod
+    def resolve_offerer(self, info, **kwargs):
+        return load_one(info, self, 'offerer', 'profile')
+
 class ProductQnA(DjangoObjectType):
     class Meta:
         model = models.ProductQnA
         fields = ['product', 'question', 'answer', 'asked_by', 'is_answered']
 
+    @staticmethod
+    def resolve_asked_by(self, info, **kwargs):
+        return load_one(info, self, 'asked_by', 'profile')
+
 class UserReport(DjangoObjectType):
     class Meta:
         model = models.UserReport
         fields = ['reported_user', 'category', 'reported_by']
 
+    @staticmethod
+    def resolve_reported_user(self, info, **kwargs):
+        return load_one(info, self, 'reported_user', 'profile')
+
+    @staticmethod
+    def resolve_reported_by(self, info, **kwargs):
+        return load_one(info, self, 'reported_by', 'profile')
+
+
+class ImageSize(graphene.Enum):
+    """
+    Renditions of product images, see main.images.RENDITIONS.
+    Images fall back to the original until their renditions have been generated.
+    """
+    THUMBNAIL = "thumbnail"
+    MEDIUM = "medium"
+    LARGE = "large"
+    ORIGINAL = "original"
+
 
 class Product(DjangoObjectType):
     class Meta:
@@ -43,31 +72,42 @@ class Product(DjangoObjectType):
             'is_negotiable': ['exact']
         }
 
-    images = graphene.List(graphene.String)
+    images = graphene.List(graphene.String, size=ImageSize(default_value=ImageSize.LARGE.value))
     offers = graphene.List(ProductOffer)
     questions = graphene.List(ProductQnA)
-    in_wishlist = graphene.Boolean
+    in_wishlist = graphene.Boolean()
     
     @staticmethod
-    def resolve_images(self, info, **kwargs):
-        return [i.image.url for i in self.images.all()]
+    def resolve_seller(self, info, **kwargs):
+        if self.seller_id is None:
+            return None
+        return load_one(info, self, 'seller', 'profile')
+
+    @staticmethod
+    def resolve_category(self, info, **kwargs):
+        return load_one(info, self, 'category', 'category')
+
+    @staticmethod
+    def resolve_images(self, info, size=ImageSize.LARGE.value, **kwargs):
+        return Promise.resolve(load_many(info, self, 'images', 'product_images')).then(
+            lambda images: [i.get_url(size) for i in images]
+        )
     
     @staticmethod
     def resolve_offers(self, info, **kwargs):
-        return self.offers.all()
+        return load_many(info, self, 'offers', 'product_offers')
 
     @staticmethod
     def resolve_questions(self, info, **kwargs):
-        return self.questions.all()
+        return load_many(info, self, 'questions', 'product_questions')
 
     @staticmethod
     def resolve_reports(self, info, **kwargs):
         return self.reports.all()
 
     @staticmethod
-    def resolve_in_wish_list(self, info, **kwargs):
-        wishlist_ids = info.context.user.profile.wishlist.values_list('id', flat=True)
-        return (self.id in wishlist_ids)
+    def resolve_in_wishlist(self, info, **kwargs):
+        return self.id in get_wishlist_ids(info)
 
 
 class Category(DjangoObjectType):
@@ -79,14 +119,15 @@ class Category(DjangoObjectType):
     
     @staticmethod
     def resolve_products(self, info, **kwargs):
-        return self.products.all()
+        return load_many(info, self, 'products', 'category_products')
                 
 
 class Profile(DjangoObjectType):
     class Meta:
         model = models.Profile
-        fields = ['id', 'name', 'contact_no', 'rating', 'email']
+        fields = ['id', 'name', 'contact_no', 'email']
         
+    rating = graphene.Float()
     username = graphene.String()
     avatar = graphene.String()
     hostel = graphene.String()
@@ -100,7 +141,10 @@ class Profile(DjangoObjectType):
 
     @staticmethod
     def resolve_avatar(self, info, **kwargs):
+        avatars = prefetched(self, 'avatar')
         try:
+            if avatars is not None:
+                return avatars[0].url
             return self.avatar.first().url
         except:
             return ""
@@ -111,15 +155,15 @@ class Profile(DjangoObjectType):
        
     @staticmethod
     def resolve_products(self, info, **kwargs):
-        return self.products.all()
+        return load_many(info, self, 'products', 'profile_products')
 
     @staticmethod
     def resolve_offers(self, info, **kwargs):
-        return self.offers.all()
+        return load_many(info, self, 'offers', 'profile_offers')
 
     @staticmethod
     def resolve_reports(self, info, **kwargs):
-        return self.reports.all()
+        return load_many(info, self, 'reports', 'profile_reports')
 
 
 class Wishlist(DjangoObjectType):
@@ -143,9 +187,28 @@ class Paginator(graphene.ObjectType):
     pages = graphene.Int()
     has_next = graphene.Boolean()
     has_prev = graphene.Boolean()
+    # Only set when paginating with cursors (`after`/`before`) instead of page numbers.
+    start_cursor = graphene.String()
+    end_cursor = graphene.String()
  
 class PaginatedProducts(Paginator, graphene.ObjectType):
     objects = graphene.List(Product)
 
 class PaginatedProfiles(Paginator, graphene.ObjectType):
     objects = graphene.List(Profile)
+
+class Facet(graphene.ObjectType):
+    value = graphene.String()
+    count = graphene.Int()
+
+class ProductSearchFacets(graphene.ObjectType):
+    categories = graphene.List(Facet)
+    prices = graphene.List(Facet)
+
+class ProductSuggestion(graphene.ObjectType):
+    id = graphene.ID()
+    name = graphene.String()
+
+class ProductSearchResults(PaginatedProducts, graphene.ObjectType):
+    total = graphene.Int()
+    facets = graphene.Field(ProductSearchFacets)
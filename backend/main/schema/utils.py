@@ -1,10 +1,94 @@
+import json
+from functools import partial
+
+from cursor_pagination import CursorPaginator, InvalidCursor
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, ValidationError
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.db import connections, transaction
+from django.utils.functional import cached_property
+
+from main import caching, models, tasks
+from main.images import store_images
+
+# Keyset orderings for cursor pagination. Both must be unique and indexed.
+PRODUCT_CURSOR_ORDERING = ('created_at', 'id')
+PROFILE_CURSOR_ORDERING = ('id',)
+
+# Exact counts are also invalidated by the model's save/delete signals (see main.models), and by
+# the writes that bypass them, such as QuerySet.update() and bulk_create(), calling invalidate_tags.
+COUNT_CACHE_TIMEOUT = 60 * 10
+
+
+def cached_count(qs):
+    """
+    Count the rows of `qs`, caching the result under the queryset's SQL.
+    """
+    try:
+        signature = str(qs.order_by().values('pk').query)
+    except EmptyResultSet:
+        return 0
+    key = caching.make_key("count", [qs.model._meta.label_lower], signature)
+    count = cache.get(key)
+    if count is None:
+        count = qs.count()
+        cache.set(key, count, COUNT_CACHE_TIMEOUT)
+    return count
+
+
+def approximate_count(qs):
+    """
+    Estimate the rows of `qs` from the Postgres planner instead of counting them:
+    `reltuples` for an unfiltered table, the EXPLAIN row estimate otherwise.
+    Product.objects always filters out hidden and expired products, so product listings
+    always take the EXPLAIN path. Returns None when no estimate is available.
+    """
+    connection = connections[qs.db]
+    if connection.vendor != 'postgresql':
+        return None
+
+    with connection.cursor() as cursor:
+        if not qs.query.where:
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [qs.model._meta.db_table])
+            row = cursor.fetchone()
+            estimate = row[0] if row else None
+        else:
+            try:
+                sql, params = qs.order_by().values('pk').query.sql_with_params()
+            except EmptyResultSet:
+                return 0
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            estimate = plan[0]["Plan"]["Plan Rows"]
+
+    # reltuples is -1 for tables that have never been analyzed.
+    if estimate is None or estimate < 0:
+        return None
+    return int(estimate)
+
+
+class CountCachingPaginator(Paginator):
+    """
+    Paginator that takes its total count from the count cache, or from the planner's
+    estimate when `approximate` is set.
+    """
+    def __init__(self, *args, approximate=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.approximate = approximate
 
-from main import models
+    @cached_property
+    def count(self):
+        if self.approximate:
+            estimate = approximate_count(self.object_list)
+            if estimate is not None:
+                return estimate
+        return cached_count(self.object_list)
 
 
-def get_paginator(qs, page_size, page, paginated_type, **kwargs):
-    p = Paginator(qs, page_size)
+def get_paginator(qs, page_size, page, paginated_type, approximate=False, **kwargs):
+    p = CountCachingPaginator(qs, page_size, approximate=approximate)
     try:
         page_obj = p.page(page)
     except PageNotAnInteger:
@@ -20,6 +104,59 @@ def get_paginator(qs, page_size, page, paginated_type, **kwargs):
         **kwargs
     )
 
+
+class KeysetPaginator(CursorPaginator):
+    """
+    CursorPaginator that rejects cursors which don't match its ordering, in length or in
+    the types of their values, instead of passing them on to the database.
+    """
+    def decode_cursor(self, cursor):
+        position = super().decode_cursor(cursor)
+        if len(position) != len(self.ordering):
+            raise InvalidCursor(self.invalid_cursor_message)
+        model = self.queryset.model
+        try:
+            return [
+                str(model._meta.get_field(order.lstrip('-')).to_python(value))
+                for order, value in zip(self.ordering, position)
+            ]
+        except ValidationError:
+            raise InvalidCursor(self.invalid_cursor_message)
+
+
+def get_cursor_paginator(qs, page_size, paginated_type, ordering, after=None, before=None, **kwargs):
+    """
+    Keyset pagination: seeks past the `after`/`before` cursor on `ordering` instead of
+    running COUNT(*) and an OFFSET scan, so every page costs the same.
+    An invalid cursor returns the first page, like an invalid page number does in get_paginator.
+    """
+    p = KeysetPaginator(qs, ordering)
+    try:
+        if before is not None:
+            page_obj = p.page(last=page_size, before=before)
+        else:
+            page_obj = p.page(first=page_size, after=after)
+    except InvalidCursor:
+        page_obj = p.page(first=page_size)
+    items = list(page_obj)
+    return paginated_type(
+        has_next=page_obj.has_next,
+        has_prev=page_obj.has_previous,
+        start_cursor=p.cursor(items[0]) if items else None,
+        end_cursor=p.cursor(items[-1]) if items else None,
+        objects=items,
+        **kwargs
+    )
+
+
+def paginate(qs, page_size, page, paginated_type, ordering, after=None, before=None, approximate=False, **kwargs):
+    """
+    Use page-number pagination when `page` is given, keyset pagination otherwise.
+    """
+    if page is None:
+        return get_cursor_paginator(qs, page_size, paginated_type, ordering, after=after, before=before, **kwargs)
+    return get_paginator(qs, page_size, page, paginated_type, approximate=approximate, **kwargs)
+
     
 def create_product(seller, files, **kwargs, ):
     """
@@ -110,20 +247,19 @@ def create_user_report(reported_by, **kwargs):
 
     return report
 
-def add_images_to_product(files, id):
+def add_images_to_product(product, files):
     """
-        Given the attributes of a Product and its related images, create new ImageModels' and add them to respective images attribute of the respective Product
+        Given a Product and uploaded files, add the files to the product's images. Files are stored once per content, see main.images.store_images, and the renditions of new images are generated in the background once the transaction commits.
     """
-    product = models.Product.objects.get(id=id)
-    if len(files.keys()) != 0:
-        for i in files.keys():
-            print(files.keys())
-            imag = models.ImageModel()
-            imag.image = files[i]
-            imag.save()
-            product.images.add(imag)
-    product.save()
+    if not files:
+        return product
+    with transaction.atomic():
+        images, unprocessed = store_images(files)
+        product.images.add(*images)
+    for image in unprocessed:
+        transaction.on_commit(partial(tasks.process_image.delay, image.id))
     return product
+
 # def update_offer(offer, **kwargs):
 
 #     fields = ['amount', 'message']
@@ -0,0 +1,73 @@
+"""
+Product search. Queries go to settings.SEARCH_BACKEND, and fail over to
+settings.SEARCH_FALLBACK_BACKEND while it is unavailable (e.g. while Elasticsearch starts up).
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from main import caching
+from main.search.base import (MAX_SUGGESTIONS, SearchBackend, SearchResults,
+                              SearchUnavailable, normalize_prefix)
+
+log = logging.getLogger("main")
+
+# Suggestions are cached per prefix for a short while, since every keystroke asks for them.
+SUGGESTION_CACHE_TIMEOUT = 30
+
+_backends = {}
+# Per process: when the primary backend may be tried again after failing.
+_primary_down_until = 0
+
+
+def get_backend(path):
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+def run(method, *args, **kwargs):
+    """
+    Call `method` on the primary backend, or on the fallback one if the primary is
+    unavailable. After a failure the primary is skipped for SEARCH_FAILOVER_TIMEOUT
+    seconds, so requests don't all wait for it to time out.
+    """
+    global _primary_down_until
+    fallback = settings.SEARCH_FALLBACK_BACKEND
+    if fallback and time.monotonic() < _primary_down_until:
+        return getattr(get_backend(fallback), method)(*args, **kwargs)
+    try:
+        return getattr(get_backend(settings.SEARCH_BACKEND), method)(*args, **kwargs)
+    except SearchUnavailable as e:
+        if not fallback:
+            raise
+        log.warning("Search backend unavailable, failing over to %s: %s", fallback, e)
+        _primary_down_until = time.monotonic() + settings.SEARCH_FAILOVER_TIMEOUT
+        return getattr(get_backend(fallback), method)(*args, **kwargs)
+
+
+def search_products(querystring, filters, page_size, page=None, after=None, before=None):
+    """
+    See SearchBackend.search_products.
+    """
+    return run("search_products", querystring, filters, page_size, page=page, after=after, before=before)
+
+
+def suggest_products(prefix, limit=5):
+    """
+    Ids and names of up to `limit` visible products with a word starting with each word of `prefix`.
+    """
+    prefix = normalize_prefix(prefix)
+    limit = max(min(limit, MAX_SUGGESTIONS), 1)
+    if not prefix:
+        return []
+
+    key = caching.make_key("suggest", [], prefix, limit)
+    suggestions = cache.get(key)
+    if suggestions is None:
+        suggestions = run("suggest_products", prefix, limit)
+        cache.set(key, suggestions, SUGGESTION_CACHE_TIMEOUT)
+    return suggestions
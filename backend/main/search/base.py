@@ -0,0 +1,73 @@
+import base64
+import json
+from collections import namedtuple
+
+# Buckets of the price facet, in rupees.
+PRICE_RANGES = [
+    {"key": "0-100", "to": 100},
+    {"key": "100-500", "from": 100, "to": 500},
+    {"key": "500-1000", "from": 500, "to": 1000},
+    {"key": "1000-5000", "from": 1000, "to": 5000},
+    {"key": "5000+", "from": 5000},
+]
+CATEGORY_FACET_SIZE = 50
+
+MAX_SUGGESTIONS = 10
+# Longer prefixes wouldn't match any more than the edge n-grams indexed, see main.documents.
+MAX_PREFIX_LENGTH = 20
+
+# `ids` are the matching product ids, in order. `products` are the same products built from
+# the backend's own copy of their data, when it keeps one (see ElasticsearchBackend), else None.
+SearchResults = namedtuple(
+    "SearchResults",
+    ["ids", "products", "total", "facets", "page", "pages", "has_next", "has_prev", "start_cursor", "end_cursor"],
+)
+
+
+class SearchUnavailable(Exception):
+    """
+    Raised by a backend that can't serve queries right now, so that the next one is used.
+    """
+
+
+def encode_cursor(sort_values):
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Sort values of the hit a cursor points at, or None if the cursor is invalid.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def normalize_prefix(prefix):
+    return " ".join(prefix.lower().split())[:MAX_PREFIX_LENGTH]
+
+
+class SearchBackend:
+    """
+    Interface of the product search backends, see settings.SEARCH_BACKEND.
+
+    `filters` are the fields of main.schema.inputs.ProductSearchFilter. Only visible,
+    unexpired products are ever returned.
+    """
+
+    def search_products(self, querystring, filters, page_size, page=None, after=None, before=None):
+        """
+        Return the SearchResults for one page of products matching `querystring` and `filters`,
+        with category and price facets. Like utils.paginate, uses page numbers when `page` is
+        given and cursors otherwise.
+        """
+        raise NotImplementedError
+
+    def suggest_products(self, prefix, limit):
+        """
+        Return the ids and names of up to `limit` products with a word starting with each
+        word of the (normalized) `prefix`.
+        """
+        raise NotImplementedError
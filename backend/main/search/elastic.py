@@ -0,0 +1,224 @@
+import math
+
+from django.utils.dateparse import parse_datetime
+from elasticsearch.exceptions import TransportError
+from elasticsearch_dsl import Q
+
+from main.documents import ProductDocument
+from main.models import Category, ImageModel, Product, Profile
+from main.search.base import (CATEGORY_FACET_SIZE, PRICE_RANGES, SearchBackend,
+                              SearchResults, SearchUnavailable, decode_cursor,
+                              encode_cursor)
+
+# _source fields needed by product_from_hit.
+PRODUCT_SOURCE = [
+    "id", "name", "description", "expected_price", "is_negotiable", "is_ticket", "sold", "visible",
+    "expired", "created_at", "category", "category_id", "seller_id", "seller_name", "images",
+]
+
+# Elasticsearch refuses pages past index.max_result_window; deeper results need cursors.
+MAX_RESULT_WINDOW = 10000
+
+# Errors meaning the cluster can't answer right now (unreachable, overloaded, or the index
+# alias doesn't exist yet), as opposed to a bad query. Connection errors have no status code.
+UNAVAILABLE_STATUSES = {"N/A", 404, 429, 500, 502, 503, 504}
+
+
+# Types of the sort values in cursors, by sort field. Dates sort as epoch milliseconds.
+SORT_VALUE_TYPES = {"_score": (int, float), "id": int, "created_at": int}
+
+
+def get_sort(querystring, reverse=False):
+    sort = [("_score", "desc"), ("id", "asc")] if querystring else [("created_at", "asc"), ("id", "asc")]
+    if reverse:
+        sort = [(field, "asc" if order == "desc" else "desc") for field, order in sort]
+    return [{field: {"order": order}} for field, order in sort]
+
+
+def decode_search_after(cursor, querystring):
+    """
+    Sort values to search after, or None if the cursor doesn't fit the sort of this search
+    (e.g. a cursor from another search or from the Postgres backend), which starts over.
+    """
+    values = decode_cursor(cursor)
+    fields = [field for sort in get_sort(querystring) for field in sort]
+    if values is None or len(values) != len(fields):
+        return None
+    for field, value in zip(fields, values):
+        if isinstance(value, bool) or not isinstance(value, SORT_VALUE_TYPES[field]):
+            return None
+    return values
+
+
+def build_product_search(querystring=None, filters=None):
+    """
+    Search for the products matching `querystring` and `filters`, with category and price facets.
+
+    The category and price filters are post filters, and each facet is only narrowed down by
+    the other one, so a facet keeps showing the counts of the values not currently selected.
+    """
+    filters = filters or {}
+    search = ProductDocument.search()
+    if querystring:
+        search = search.query("multi_match", fields=["name", "description"], query=querystring)
+
+    search = search.filter("term", visible=True).filter("term", expired=False)
+    for field in ("is_negotiable", "is_ticket", "sold"):
+        if filters.get(field) is not None:
+            search = search.filter("term", **{field: filters[field]})
+    if filters.get("hostel"):
+        search = search.filter("term", seller_hostel=filters["hostel"])
+
+    category_filter = Q("terms", category=filters["categories"]) if filters.get("categories") else None
+    price_range = {
+        bound: filters[name]
+        for bound, name in (("gte", "min_price"), ("lte", "max_price"))
+        if filters.get(name) is not None
+    }
+    price_filter = Q("range", expected_price=price_range) if price_range else None
+
+    post_filters = [f for f in (category_filter, price_filter) if f is not None]
+    if post_filters:
+        search = search.post_filter("bool", filter=post_filters)
+
+    search.aggs.bucket("categories", "filter", filter=price_filter or Q("match_all")).bucket(
+        "categories", "terms", field="category", size=CATEGORY_FACET_SIZE
+    )
+    search.aggs.bucket("prices", "filter", filter=category_filter or Q("match_all")).bucket(
+        "prices", "range", field="expected_price", ranges=PRICE_RANGES
+    )
+    return search.source(PRODUCT_SOURCE)
+
+
+def build_suggestion_search(prefix, limit):
+    return (
+        ProductDocument.search()
+        .query("match", **{"name.autocomplete": {"query": prefix, "operator": "and"}})
+        .filter("term", visible=True)
+        .filter("term", expired=False)
+        .source(["name"])
+    )[:limit]
+
+
+def get_facets(response):
+    return {
+        "categories": [
+            {"value": bucket.key, "count": bucket.doc_count}
+            for bucket in response.aggregations.categories.categories.buckets
+        ],
+        "prices": [
+            {"value": bucket.key, "count": bucket.doc_count}
+            for bucket in response.aggregations.prices.prices.buckets
+        ],
+    }
+
+
+def get_total(response):
+    total = response.hits.total
+    # An int before Elasticsearch 7, an object after.
+    return getattr(total, "value", total)
+
+
+def execute(search):
+    try:
+        return search.execute()
+    except TransportError as e:
+        if e.status_code in UNAVAILABLE_STATUSES:
+            raise SearchUnavailable(str(e)) from e
+        raise
+
+
+def product_from_hit(hit):
+    """
+    Build an unsaved Product from a search hit's _source, with its category, seller and images
+    attached as if they had been loaded with select_related/prefetch_related.
+    Only the fields in PRODUCT_SOURCE are set.
+    """
+    source = hit.to_dict()
+    created_at = source.get("created_at")
+    product = Product(
+        id=int(hit.meta.id),
+        name=source.get("name", ""),
+        description=source.get("description", ""),
+        expected_price=source.get("expected_price"),
+        is_negotiable=source.get("is_negotiable", False),
+        is_ticket=source.get("is_ticket", False),
+        sold=source.get("sold", False),
+        visible=source.get("visible", True),
+        expired=source.get("expired", False),
+        created_at=parse_datetime(created_at) if isinstance(created_at, str) else created_at,
+    )
+    category_id = source.get("category_id")
+    product.category = Category(id=category_id, name=source.get("category")) if category_id else None
+    seller_id = source.get("seller_id")
+    product.seller = Profile(id=seller_id, name=source.get("seller_name", "")) if seller_id else None
+    product._prefetched_objects_cache = {
+        "images": [ImageModel(**dict(image)) for image in source.get("images", [])],
+    }
+    return product
+
+
+def get_results(hits, **kwargs):
+    return SearchResults(
+        ids=[int(hit.meta.id) for hit in hits],
+        products=[product_from_hit(hit) for hit in hits],
+        **kwargs
+    )
+
+
+class ElasticsearchBackend(SearchBackend):
+    """
+    Searches the products index. Results carry the products built from the hits' _source.
+    """
+
+    def search_products(self, querystring, filters, page_size, page=None, after=None, before=None):
+        search = build_product_search(querystring, filters)
+
+        if page is not None:
+            # Pages past the result window can't be fetched, so they aren't counted either.
+            max_pages = MAX_RESULT_WINDOW // page_size
+            page = max(min(page, max_pages), 1)
+            start = (page - 1) * page_size
+            response = execute(search.sort(*get_sort(querystring))[start:start + page_size])
+            total = get_total(response)
+            pages = max(min(math.ceil(total / page_size), max_pages), 1)
+            return get_results(
+                list(response),
+                total=total,
+                facets=get_facets(response),
+                page=page,
+                pages=pages,
+                has_next=page < pages,
+                has_prev=page > 1,
+                start_cursor=None,
+                end_cursor=None,
+            )
+
+        cursor = decode_search_after(before or after, querystring) if (before or after) else None
+        backwards = before is not None and cursor is not None
+        search = search.sort(*get_sort(querystring, reverse=backwards))
+        if cursor is not None:
+            search = search.extra(search_after=cursor)
+        # One extra hit tells whether there is another page.
+        response = execute(search[:page_size + 1])
+        hits = list(response)
+        more = len(hits) > page_size
+        hits = hits[:page_size]
+        if backwards:
+            hits.reverse()
+
+        return get_results(
+            hits,
+            total=get_total(response),
+            facets=get_facets(response),
+            page=None,
+            pages=None,
+            has_next=True if backwards else more,
+            has_prev=more if backwards else cursor is not None,
+            start_cursor=encode_cursor(list(hits[0].meta.sort)) if hits else None,
+            end_cursor=encode_cursor(list(hits[-1].meta.sort)) if hits else None,
+        )
+
+    def suggest_products(self, prefix, limit):
+        response = execute(build_suggestion_search(prefix, limit))
+        return [{"id": int(hit.meta.id), "name": hit.name} for hit in response]
@@ -0,0 +1,156 @@
+import math
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import Count, F, Q
+
+from main.models import SEARCH_CONFIG, Product
+from main.search.base import (CATEGORY_FACET_SIZE, PRICE_RANGES, SearchBackend,
+                              SearchResults, decode_cursor, encode_cursor)
+
+WORD = re.compile(r"\w+")
+
+
+def match_words(fields, text):
+    """
+    Products with every word of `text` in one of `fields`. The substring fallback for
+    databases without full-text search, such as SQLite in local development.
+    """
+    match = Q()
+    for word in WORD.findall(text):
+        any_field = Q()
+        for field in fields:
+            any_field |= Q(**{f"{field}__icontains": word})
+        match &= any_field
+    return match
+
+
+def search_queryset(querystring):
+    """
+    Products matching `querystring`, best matches first.
+    """
+    products = Product.objects.all()
+    if not querystring:
+        return products.order_by("created_at", "id")
+    if connection.vendor != "postgresql":
+        return products.filter(match_words(["name", "description"], querystring)).order_by("created_at", "id")
+
+    query = SearchQuery(querystring, config=SEARCH_CONFIG)
+    return (
+        products.filter(search_vector=query)
+        .annotate(rank=SearchRank(F("search_vector"), query))
+        .order_by("-rank", "id")
+    )
+
+
+def price_range_filter(bounds):
+    # Like Elasticsearch's range aggregation, "from" is inclusive and "to" exclusive.
+    return Q(**{
+        lookup: bounds[bound]
+        for bound, lookup in (("from", "expected_price__gte"), ("to", "expected_price__lt"))
+        if bound in bounds
+    })
+
+
+def get_facets(products, category_filter, price_filter):
+    """
+    Category and price facets, each narrowed down by the other one's filter only,
+    like main.search.elastic.build_product_search.
+    """
+    categories = (
+        products.filter(price_filter)
+        .exclude(category=None)
+        .order_by()
+        .values("category__name")
+        .annotate(count=Count("id"))
+        .order_by("-count", "category__name")[:CATEGORY_FACET_SIZE]
+    )
+    prices = products.filter(category_filter).aggregate(**{
+        f"price_{i}": Count("id", filter=price_range_filter(bounds))
+        for i, bounds in enumerate(PRICE_RANGES)
+    })
+    return {
+        "categories": [{"value": row["category__name"], "count": row["count"]} for row in categories],
+        "prices": [
+            {"value": bounds["key"], "count": prices[f"price_{i}"]}
+            for i, bounds in enumerate(PRICE_RANGES)
+        ],
+    }
+
+
+def decode_offset(cursor):
+    """
+    Cursors of this backend hold the offset of a result. Others (such as the sort values
+    of an Elasticsearch hit, after a failover) are treated as invalid.
+    """
+    values = decode_cursor(cursor) if cursor else None
+    if values and len(values) == 1 and isinstance(values[0], int):
+        return values[0]
+    return None
+
+
+class PostgresBackend(SearchBackend):
+    """
+    Searches Product.search_vector with Postgres full-text search, or the name and
+    description with substring matches on other databases.
+
+    Slower than Elasticsearch on large result sets (facets and totals are counted with SQL),
+    and cursors are plain offsets, so it is meant as a fallback and for local development.
+    """
+
+    def search_products(self, querystring, filters, page_size, page=None, after=None, before=None):
+        products = search_queryset(querystring)
+        for field in ("is_negotiable", "is_ticket", "sold"):
+            if filters.get(field) is not None:
+                products = products.filter(**{field: filters[field]})
+        if filters.get("hostel"):
+            products = products.filter(seller__hostel=filters["hostel"])
+
+        category_filter = Q(category__name__in=filters["categories"]) if filters.get("categories") else Q()
+        price_filter = Q(**{
+            lookup: filters[name]
+            for lookup, name in (("expected_price__gte", "min_price"), ("expected_price__lte", "max_price"))
+            if filters.get(name) is not None
+        })
+        facets = get_facets(products, category_filter, price_filter)
+        products = products.filter(category_filter, price_filter)
+        total = products.count()
+
+        if page is not None:
+            pages = max(math.ceil(total / page_size), 1)
+            page = max(page, 1)
+            start = (page - 1) * page_size
+        else:
+            pages = None
+            before_offset = decode_offset(before)
+            after_offset = decode_offset(after)
+            if before_offset is not None:
+                start = max(before_offset - page_size, 0)
+                page_size = before_offset - start
+            else:
+                start = after_offset + 1 if after_offset is not None else 0
+
+        ids = list(products.values_list("id", flat=True)[start:start + page_size])
+        end = start + len(ids)
+        return SearchResults(
+            ids=ids,
+            products=None,
+            total=total,
+            facets=facets,
+            page=page,
+            pages=pages,
+            has_next=end < total,
+            has_prev=start > 0,
+            start_cursor=encode_cursor([start]) if ids and page is None else None,
+            end_cursor=encode_cursor([end - 1]) if ids and page is None else None,
+        )
+
+    def suggest_products(self, prefix, limit):
+        match = Q()
+        for word in WORD.findall(prefix):
+            match &= Q(name__istartswith=word) | Q(name__icontains=f" {word}")
+        if not match:
+            return []
+        products = Product.objects.filter(match).order_by("-created_at").values_list("id", "name")
+        return [{"id": pk, "name": name} for pk, name in products[:limit]]
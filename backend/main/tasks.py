@@ -1,6 +1,29 @@
 from __future__ import absolute_import, unicode_literals
 from celery import shared_task
 
+from main import images, indexing, outbox
+
+
 @shared_task
 def add(x, y):
-    return x + y
\ No newline at end of file
+    return x + y
+
+
+@shared_task
+def drain_outbox():
+    return outbox.drain_outbox()
+
+
+@shared_task
+def process_image(image_id):
+    return images.process_image(image_id)
+
+
+@shared_task
+def collect_images():
+    return images.collect_images()
+
+
+@shared_task
+def flush_search_index():
+    return indexing.flush_search_index()
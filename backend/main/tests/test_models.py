@@ -1,10 +1,27 @@
+import json
+import os
 import random
+import tempfile
+from io import BytesIO
+from unittest import mock
 
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.db.models.query import QuerySet
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
 
+from main import images, indexing, outbox
 from main.auth_helpers import create_user_from_email
-from main.models import (Category, Product, ProductOffer, Profile,
-                         ProfileRating, User)
+from main.documents import ProductDocument
+from main.management.commands import rebuild_search_index
+from main.schema.utils import cached_count
+from main.models import (Category, ImageModel, OutboxEvent, Product, ProductOffer,
+                         Profile, ProfileRating, User, UserReport)
 
 
 class TestUserProfile(TestCase):
@@ -32,6 +49,25 @@ class TestUserProfile(TestCase):
         self.assertEqual(profile.email, "test_username@domain.com")
         self.assertEqual(profile.permission_level, Profile.BUYER)
 
+    def test_permission_level_is_saved(self):
+        self.create_non_bitsian_user()
+        profile = Profile.objects.get(user__username="test_username")
+        self.assertEqual(profile.permission_level, Profile.BUYER)
+
+    def test_user_is_created_in_one_transaction(self):
+        # SAVEPOINT, one INSERT each for the user, profile and wishlist, RELEASE SAVEPOINT.
+        with self.assertNumQueries(5):
+            user = self.create_bitsian_user()
+        self.assertFalse(user.has_usable_password())
+        self.assertIsNotNone(user.profile.wishlist.id)
+
+    def test_user_is_not_created_if_profile_fails(self):
+        with mock.patch("main.models.Wishlist.save", side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                self.create_bitsian_user()
+        self.assertFalse(User.objects.filter(username="f20190120").exists())
+        self.assertFalse(Profile.objects.exists())
+
     def test_profile_is_complete(self):
         user = self.create_bitsian_user()
         profile = user.profile
@@ -53,7 +89,9 @@ class TestProfileRating(TestCase):
         rating = ProfileRating(rating_for=profile1,
                                rated_by=profile2, rating=RATING)
         rating.save()
+        outbox.drain_outbox()
         # Test that user's profile rating is updated.
+        profile1.refresh_from_db()
         self.assertEqual(profile1.rating, RATING)
 
 
@@ -100,6 +138,25 @@ class TestProduct(TestCase):
         product.save()
         self.assertEqual(product.sold, True)
 
+class TestSearchVector(TestCase):
+    def setUp(self):
+        product = Product.objects.create(name="Product", expected_price=100, description="")
+        self.product = Product.objects.get(pk=product.pk)
+
+    def assert_updated(self, updated):
+        with mock.patch("main.models.update_search_vectors") as update_search_vectors:
+            self.product.save()
+        self.assertEqual(update_search_vectors.called, updated)
+
+    def test_renamed_product_is_updated(self):
+        self.product.name = "Renamed"
+        self.assert_updated(True)
+
+    def test_unchanged_text_is_not_updated(self):
+        self.product.expected_price = 200
+        self.assert_updated(False)
+
+
 class TestProductOffer(TestCase):
     def create_test_user(self, email):
         return create_user_from_email(email)
@@ -147,12 +204,21 @@ class TestProductOffer(TestCase):
     def test_num_offers(self):
         # Create offer on a product and test product's no. of offers
         offer = self.create_test_offer(email="one@domain.com")
+        outbox.drain_outbox()
+        offer.product.refresh_from_db()
         self.assertEqual(offer.product.num_offers, 1)
 
         # Create another offer on the same product and test product's no. of offers
         offer = self.create_test_offer(email="two@domain.com", product=offer.product)
+        outbox.drain_outbox()
+        offer.product.refresh_from_db()
         self.assertEqual(offer.product.num_offers, 2)
 
+    def test_one_offer_per_buyer(self):
+        offer = self.create_test_offer()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ProductOffer.objects.create(offerer=offer.offerer, product=offer.product, amount=10, message='Again')
+
 
 class TestProfileRating(TestCase):
     def create_test_user(self, email):
@@ -165,5 +231,334 @@ class TestProfileRating(TestCase):
 
         rating = ProfileRating(rating_for=profile1, rated_by=profile2, rating=RATING)
         rating.save()
+        outbox.drain_outbox()
         # Test that user's profile rating is updated.
+        profile1.refresh_from_db()
         self.assertEqual(profile1.rating, RATING)
+
+    def test_ratings_are_averaged(self):
+        profile1 = self.create_test_user("userone@gmail.com").profile
+        profile2 = self.create_test_user("usertwo@gmail.com").profile
+        profile3 = self.create_test_user("userthree@gmail.com").profile
+
+        ProfileRating(rating_for=profile1, rated_by=profile2, rating=4).save()
+        ProfileRating(rating_for=profile1, rated_by=profile3, rating=5).save()
+        outbox.drain_outbox()
+
+        profile1 = Profile.objects.get(pk=profile1.pk)
+        self.assertEqual(profile1.num_ratings, 2)
+        self.assertEqual(profile1.rating, 4.5)
+
+    def test_rebuild_ratings(self):
+        profile1 = self.create_test_user("userone@gmail.com").profile
+        profile2 = self.create_test_user("usertwo@gmail.com").profile
+        ProfileRating(rating_for=profile1, rated_by=profile2, rating=3).save()
+        Profile.objects.update(rating_sum=0, num_ratings=0)
+
+        call_command("rebuild_ratings", stdout=open(os.devnull, "w"))
+
+        profile1 = Profile.objects.get(pk=profile1.pk)
+        self.assertEqual(profile1.num_ratings, 1)
+        self.assertEqual(profile1.rating, 3)
+
+
+class TestProductImportExport(TestCase):
+    def setUp(self):
+        self.seller = create_user_from_email("seller@gmail.com")
+
+    def test_products_round_trip(self):
+        rows = [
+            {"name": f"Product {i}", "description": "desc", "expected_price": 100 + i,
+             "category": "Electronics", "seller": self.seller.username, "is_negotiable": True}
+            for i in range(5)
+        ]
+        cache.clear()
+        self.assertEqual(cached_count(Product.objects.all()), 0)
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "products.jsonl")
+            with open(source, "w") as f:
+                f.writelines(json.dumps(row) + "\n" for row in rows)
+            call_command("import_products", source, "--skip-index", "--chunk-size", "2", stdout=open(os.devnull, "w"))
+
+            self.assertEqual(Product.objects.filter(seller=self.seller.profile).count(), 5)
+            # The cached count was invalidated by the import.
+            self.assertEqual(cached_count(Product.objects.all()), 5)
+            self.assertEqual(Category.objects.filter(name="Electronics").count(), 1)
+
+            exported = os.path.join(directory, "export.jsonl")
+            call_command("export_products", exported, stderr=open(os.devnull, "w"))
+            with open(exported) as f:
+                exported_rows = [json.loads(line) for line in f]
+
+        self.assertEqual(sorted(row["name"] for row in exported_rows), [row["name"] for row in rows])
+        self.assertTrue(all(row["seller"] == self.seller.username for row in exported_rows))
+
+    def test_imported_images_are_stored_by_content(self):
+        rows = [{"name": f"Product {i}", "expected_price": 100, "images": ["upload/a.jpg"]} for i in range(2)]
+        with tempfile.TemporaryDirectory() as directory, override_settings(MEDIA_ROOT=directory):
+            os.makedirs(os.path.join(directory, "upload"))
+            with open(os.path.join(directory, "upload", "a.jpg"), "wb") as f:
+                f.write(b"image")
+            source = os.path.join(directory, "products.jsonl")
+            with open(source, "w") as f:
+                f.writelines(json.dumps(row) + "\n" for row in rows)
+
+            with mock.patch("main.tasks.process_image.delay") as delay, \
+                    mock.patch("django.db.transaction.on_commit", side_effect=lambda f: f()):
+                call_command("import_products", source, "--skip-index", stdout=open(os.devnull, "w"))
+
+        image = ImageModel.objects.get()
+        self.assertIsNotNone(image.sha256)
+        delay.assert_called_once_with(image.id)
+
+
+class TestImageProcessing(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root.name)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.media_root.cleanup()
+
+    def create_image(self, size):
+        exif = Image.Exif()
+        exif[0x010F] = "Camera maker"
+        out = BytesIO()
+        Image.new("RGB", size, "red").save(out, format="JPEG", exif=exif)
+        return ImageModel.objects.create(image=SimpleUploadedFile("photo.jpg", out.getvalue()))
+
+    def test_renditions_are_generated(self):
+        image = self.create_image((2000, 1000))
+        self.assertEqual(image.get_url("thumbnail"), image.image.url)
+
+        images.process_image(image.id)
+
+        image.refresh_from_db()
+        for field, max_size in images.RENDITIONS.items():
+            with getattr(image, field).open("rb") as f:
+                rendition = Image.open(f)
+                self.assertEqual(max(rendition.size), max_size)
+                self.assertEqual(len(rendition.getexif()), 0)
+        self.assertEqual(image.get_url("thumbnail"), image.thumbnail.url)
+        self.assertEqual(image.get_url("original"), image.image.url)
+
+
+class TestImageStore(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root.name)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.media_root.cleanup()
+
+    def upload(self, content):
+        return SimpleUploadedFile("photo.jpg", content)
+
+    def create_product(self):
+        return Product.objects.create(name="Product", expected_price=100, description="")
+
+    def test_duplicate_uploads_share_an_image(self):
+        first, unprocessed = images.store_images([self.upload(b"same"), self.upload(b"other")])
+        self.assertEqual(len(unprocessed), 2)
+
+        second, unprocessed = images.store_images([self.upload(b"same")])
+
+        self.assertEqual(second[0].id, first[0].id)
+        self.assertEqual(ImageModel.objects.count(), 2)
+        self.assertTrue(first[0].image.name.startswith(f"images/{first[0].sha256[:2]}/"))
+
+    def test_unreferenced_images_are_collected(self):
+        (image,), _ = images.store_images([self.upload(b"same")])
+        product1, product2 = self.create_product(), self.create_product()
+        product1.images.add(image)
+        product2.images.add(image)
+        image.refresh_from_db()
+
+        product1.images.remove(image)
+        product2.delete()
+        image.refresh_from_db()
+        self.assertEqual(image.ref_count, 0)
+
+        ImageModel.objects.filter(pk=image.pk).update(
+            unreferenced_at=image.unreferenced_at - images.UNREFERENCED_GRACE_PERIOD
+        )
+        self.assertEqual(images.collect_images(), 1)
+        self.assertFalse(os.path.exists(image.image.path))
+
+    def test_image_reused_during_collection_is_kept(self):
+        (image,), _ = images.store_images([self.upload(b"same")])
+        ImageModel.objects.filter(pk=image.pk).update(
+            unreferenced_at=timezone.now() - 2 * images.UNREFERENCED_GRACE_PERIOD
+        )
+        product = self.create_product()
+        select_for_update = QuerySet.select_for_update
+
+        def reuse_image(queryset, *args, **kwargs):
+            # An upload of the same content links the image after it was found unused.
+            product.images.add(image)
+            return select_for_update(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, "select_for_update", autospec=True, side_effect=reuse_image):
+            self.assertEqual(images.collect_images(), 0)
+        self.assertTrue(ImageModel.objects.filter(pk=image.pk).exists())
+        self.assertTrue(os.path.exists(image.image.path))
+
+    def test_reference_counts_are_rebuilt(self):
+        (linked, unlinked), _ = images.store_images([self.upload(b"linked"), self.upload(b"unlinked")])
+        self.create_product().images.add(linked)
+        ImageModel.objects.filter(pk=linked.pk).update(ref_count=0, unreferenced_at=timezone.now())
+        ImageModel.objects.filter(pk=unlinked.pk).update(ref_count=3)
+
+        call_command("rebuild_image_refs", stdout=open(os.devnull, "w"))
+
+        linked.refresh_from_db()
+        unlinked.refresh_from_db()
+        self.assertEqual((linked.ref_count, linked.unreferenced_at), (1, None))
+        self.assertEqual(unlinked.ref_count, 0)
+        self.assertIsNotNone(unlinked.unreferenced_at)
+
+
+class TestQueuedIndexing(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(name="Product", expected_price=100, description="")
+        self.product = Product.objects.get(pk=self.product.pk)
+
+    def assert_queued(self, queued):
+        with mock.patch.object(indexing.QueuedSignalProcessor, "enqueue") as enqueue:
+            self.product.save()
+        self.assertEqual(enqueue.called, queued)
+
+    def test_changed_product_is_queued(self):
+        self.product.name = "Renamed"
+        self.assert_queued(True)
+
+    def test_unchanged_product_is_not_queued(self):
+        self.product.num_offers += 1
+        self.assert_queued(False)
+
+    def test_rebuild_prefetches_images_per_page(self):
+        for _ in range(4):
+            product = Product.objects.create(name="Product", expected_price=100, description="")
+            product.images.add(ImageModel.objects.create(image="images/photo.jpg"))
+        indexed = []
+
+        def bulk(actions):
+            indexed.extend(actions)
+            return len(indexed), []
+
+        with mock.patch.object(ProductDocument.django, "queryset_pagination", 10), \
+                mock.patch.object(ProductDocument, "bulk", side_effect=bulk), \
+                mock.patch.object(rebuild_search_index, "connections"):
+            # The count, the page and the page's images.
+            with self.assertNumQueries(3):
+                rebuild_search_index.Command().index_range(
+                    ProductDocument, "products_v2", (self.product.pk, self.product.pk + 10)
+                )
+
+        self.assertEqual(len(indexed), 5)
+        self.assertEqual(len(indexed[1]["_source"]["images"]), 1)
+
+
+class TestOutbox(TestCase):
+    def setUp(self):
+        self.seller = create_user_from_email("seller@gmail.com").profile
+        self.buyer = create_user_from_email("buyer@gmail.com").profile
+        self.product = Product.objects.create(name="Product", expected_price=100, description="", seller=self.seller)
+
+    def test_write_records_one_event(self):
+        # The offer and the event, without re-saving the product.
+        with self.assertNumQueries(2):
+            ProductOffer.objects.create(offerer=self.buyer, product=self.product, amount=100, message="")
+        event = OutboxEvent.objects.get()
+        self.assertEqual((event.kind, event.model, event.object_id), (OutboxEvent.OFFER, "main.product", self.product.pk))
+
+    def test_event_is_not_kept_without_its_write(self):
+        with mock.patch("main.models.OutboxEvent.objects.bulk_create", side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                ProfileRating.objects.create(rating_for=self.seller, rated_by=self.buyer, rating=4)
+        self.assertFalse(ProfileRating.objects.exists())
+
+    def test_drain_applies_events_in_batches(self):
+        ProfileRating.objects.create(rating_for=self.seller, rated_by=self.buyer, rating=4)
+        ProductOffer.objects.create(offerer=self.buyer, product=self.product, amount=100, message="")
+
+        with self.settings(OUTBOX_BATCH_SIZE=1), mock.patch("main.tasks.drain_outbox.delay") as delay:
+            self.assertEqual(outbox.drain_outbox(), 1)
+            self.assertTrue(delay.called)
+            self.assertEqual(outbox.drain_outbox(), 1)
+        self.assertEqual(outbox.drain_outbox(), 0)
+
+        self.seller.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual((self.seller.rating, self.product.num_offers), (4, 1))
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_failed_drain_keeps_events(self):
+        ProfileRating.objects.create(rating_for=self.seller, rated_by=self.buyer, rating=4)
+        with mock.patch("main.outbox.invalidate_tags", side_effect=ConnectionError), \
+                self.assertLogs("main", "ERROR"):
+            self.assertEqual(outbox.drain_outbox(), 0)
+        self.assertEqual(OutboxEvent.objects.get().attempts, 1)
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.num_ratings, 0)
+
+    def test_failing_kind_does_not_block_the_others(self):
+        ProfileRating.objects.create(rating_for=self.seller, rated_by=self.buyer, rating=4)
+        ProductOffer.objects.create(offerer=self.buyer, product=self.product, amount=100, message="")
+
+        with mock.patch("main.outbox.update_ratings", side_effect=ValueError), self.assertLogs("main", "ERROR"):
+            self.assertEqual(outbox.drain_outbox(), 1)
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.num_offers, 1)
+        self.assertEqual(OutboxEvent.objects.get().kind, OutboxEvent.RATING)
+
+        # Events that keep failing are left aside.
+        OutboxEvent.objects.update(attempts=settings.OUTBOX_MAX_ATTEMPTS)
+        with mock.patch("main.outbox.update_ratings") as update_ratings:
+            self.assertEqual(outbox.drain_outbox(), 0)
+        self.assertFalse(update_ratings.called)
+        self.assertTrue(OutboxEvent.objects.exists())
+
+    def test_reported_profile_is_banned(self):
+        for i in range(outbox.MAX_ALLOWED_REPORTS + 1):
+            reporter = create_user_from_email(f"reporter{i}@gmail.com").profile
+            UserReport.objects.create(reported_user=self.seller, reported_by=reporter, category=1)
+        outbox.drain_outbox()
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.permission_level, Profile.BANNED)
+
+    def test_renamed_seller_products_are_reindexed(self):
+        self.seller.name = "New name"
+        self.seller.save()
+        with mock.patch("main.outbox.indexing.queue_objects") as queue_objects:
+            outbox.drain_outbox()
+        queue_objects.assert_called_once_with(Product, [self.product.pk])
+
+    def test_moved_seller_products_are_reindexed(self):
+        self.seller.hostel = "KR"
+        self.seller.save()
+        with mock.patch("main.outbox.indexing.queue_objects") as queue_objects:
+            outbox.drain_outbox()
+        queue_objects.assert_called_once_with(Product, [self.product.pk])
+
+    @override_settings(ELASTICSEARCH_DSL_AUTOSYNC=True)
+    def test_product_is_not_saved_without_its_index_event(self):
+        self.product.name = "Renamed"
+        with mock.patch("main.models.OutboxEvent.objects.bulk_create", side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                self.product.save()
+        # The save joined the test's transaction, which the failure marked for rollback.
+        self.assertTrue(transaction.get_rollback())
+        transaction.set_rollback(False)
+
+    def test_index_events_are_queued(self):
+        with mock.patch("main.indexing.DEDConfig.autosync_enabled", return_value=True):
+            indexing.QueuedSignalProcessor.enqueue(None, self.product)
+        with mock.patch("main.outbox.indexing.queue_for_indexing") as queue_for_indexing:
+            outbox.drain_outbox()
+        queue_for_indexing.assert_called_once_with([f"main.product:{self.product.pk}"])
@@ -1,12 +1,13 @@
 import json
 import tempfile
+from unittest import mock
 
 from django.test import RequestFactory, TestCase
 from graphene.test import Client
 
 from main.auth_helpers import (create_product_from_email,
                                create_user_from_email, get_jwt_with_user)
-from main.models import UserReport
+from main.models import ProductOffer, UserReport
 from main.tests.utils import execute_request_with_user
 from marketplace.schema import schema
 
@@ -203,6 +204,20 @@ class TestOfferMutations(TestCase):
         errors = data['errors']
         self.assertEqual(errors[0], "You cannot create multiple offers")
 
+    def test_concurrent_duplicate_offer_is_rejected(self):
+        query_string, _ = self.generate_query_string(with_amount=True, is_negotiable=True)
+        user = create_user_from_email('buyer@xyz.in')
+        execute_request_with_user(query_string, user=user)
+
+        # Another request's offer lands between the duplicate check and the insert.
+        with mock.patch('django.db.models.query.QuerySet.exists', return_value=False):
+            result = execute_request_with_user(query_string, user=user)
+
+        data = result['data']['createOffer']
+        self.assertEqual(data['ok'], False)
+        self.assertEqual(data['errors'], ["You cannot create multiple offers"])
+        self.assertEqual(ProductOffer.objects.count(), 1)
+
     def test_user_cannot_make_offer_without_amount(self):
         query_string, _ = self.generate_query_string(with_amount=False, is_negotiable=True)
         user = create_user_from_email('buyer@xyz.in')
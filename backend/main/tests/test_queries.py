@@ -1,11 +1,21 @@
+import base64
 from random import randint
+from unittest import mock
 
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
+from main import search
+from main.search import elastic, postgres
+from main.search.base import encode_cursor
+from main.documents import ProductDocument
 from main.auth_helpers import create_user_from_email
 from main.models import *
 from main.tests.utils import execute_request_with_user
+from marketplace.schema import document_backend
 from model_bakery import baker
 
 
@@ -57,6 +67,189 @@ class TestAllProductsQuery(TestCase):
         self.assertEqual(error["message"], "You do not have permission to perform this action") # comparing the error message 
         
 
+class TestProductsQueryBatching(TestCase):
+
+    query_string = '''query{
+                        products(page: 1,
+                                 pagesize: 50) {
+                                                objects{
+                                                    name
+                                                    images
+                                                    category{
+                                                        name
+                                                        }
+                                                    seller {
+                                                        name
+                                                        }
+                                                    offers {
+                                                        offerer {
+                                                            name
+                                                            }
+                                                        }
+                                                    }
+                                                }
+                                            }'''
+
+    def make_products(self, quantity):
+        users = baker.make(User, _quantity=quantity)
+        category = baker.make(Category)
+        for i in range(quantity):
+            product = baker.make(Product, seller = users[i].profile, category = category)
+            baker.make(ProductOffer, offerer = users[i-1].profile, product = product, amount = randint(0, 10000))
+
+    def count_queries(self, user):
+        with CaptureQueriesContext(connection) as queries:
+            result = execute_request_with_user(self.query_string, user = user)
+        self.assertNotIn('errors', result)
+        return len(queries)
+
+    def test_nested_fields_do_not_query_per_product(self):
+        user = create_user_from_email('user@marketplace.com')
+        self.make_products(5)
+        num_queries = self.count_queries(user)
+
+        self.make_products(5)
+        self.assertEqual(self.count_queries(user), num_queries)
+
+
+class TestInWishlist(TestCase):
+
+    query_string = '''query {
+                        products(page: 1, pagesize: 50) {
+                            objects { id %s }
+                        }
+                    }'''
+
+    def setUp(self):
+        self.user = create_user_from_email('user@marketplace.com')
+        self.products = baker.make(Product, _quantity=50)
+        self.user.profile.wishlist.products.add(*self.products[:2])
+
+    def run_query(self, fields):
+        with CaptureQueriesContext(connection) as queries:
+            result = execute_request_with_user(self.query_string % fields, user=self.user)
+        self.assertNotIn('errors', result)
+        return result['data']['products']['objects'], len(queries)
+
+    def test_in_wishlist_is_loaded_once_per_request(self):
+        # Warm the count cache.
+        self.run_query('')
+        _, base_queries = self.run_query('')
+        objects, num_queries = self.run_query('inWishlist')
+
+        self.assertEqual(num_queries, base_queries + 1)
+        wishlisted = {int(p['id']) for p in objects if p['inWishlist']}
+        self.assertEqual(wishlisted, {p.id for p in self.products[:2]})
+
+
+class TestProductsQueryPlanning(TestCase):
+
+    query_string = '''query{
+                        products(page: 1,
+                                 pagesize: 5) {
+                                                objects{
+                                                    name
+                                                    }
+                                                }
+                                            }'''
+
+    def test_unselected_columns_are_not_loaded(self):
+        user = create_user_from_email('user@marketplace.com')
+        baker.make(Product, _quantity=3)
+        with CaptureQueriesContext(connection) as queries:
+            result = execute_request_with_user(self.query_string, user = user)
+
+        self.assertNotIn('errors', result)
+        product_queries = [q['sql'] for q in queries if 'FROM "main_product"' in q['sql'] and 'COUNT' not in q['sql']]
+        self.assertEqual(len(product_queries), 1)
+        self.assertIn('"main_product"."name"', product_queries[0])
+        self.assertNotIn('"main_product"."description"', product_queries[0])
+
+
+class TestProductsCursorPagination(TestCase):
+
+    query_string = '''query($after: String){
+                        products(pagesize: 2,
+                                 after: $after) {
+                                                page
+                                                hasNext
+                                                hasPrev
+                                                endCursor
+                                                objects{
+                                                    id
+                                                    }
+                                                }
+                                            }'''
+
+    def setUp(self):
+        self.products = baker.make(Product, _quantity=5)
+
+    def test_user_can_page_with_cursors(self):
+        user = create_user_from_email('user@marketplace.com')
+        seen = []
+        after = None
+        for _ in range(3):
+            result = execute_request_with_user(self.query_string, user = user, variables={'after': after})
+            self.assertNotIn('errors', result)
+            data = result['data']['products']
+            self.assertIsNone(data['page'])
+            seen.extend(int(p['id']) for p in data['objects'])
+            after = data['endCursor']
+
+        self.assertFalse(data['hasNext'])
+        self.assertTrue(data['hasPrev'])
+        self.assertEqual(seen, [p.id for p in self.products])
+
+    def test_invalid_cursor_returns_first_page(self):
+        user = create_user_from_email('user@marketplace.com')
+        result = execute_request_with_user(self.query_string, user = user, variables={'after': 'not-a-cursor'})
+
+        self.assertNotIn('errors', result)
+        data = result['data']['products']
+        self.assertEqual([int(p['id']) for p in data['objects']], [p.id for p in self.products[:2]])
+
+    def test_cursor_with_wrong_types_returns_first_page(self):
+        user = create_user_from_email('user@marketplace.com')
+        cursor = base64.b64encode(b'yesterday|first').decode()
+        result = execute_request_with_user(self.query_string, user = user, variables={'after': cursor})
+
+        self.assertNotIn('errors', result)
+        data = result['data']['products']
+        self.assertEqual([int(p['id']) for p in data['objects']], [p.id for p in self.products[:2]])
+
+
+class TestProductsCountCache(TestCase):
+
+    query_string = '''query{
+                        products(page: 1,
+                                 pagesize: 2) {
+                                                pages
+                                                }
+                                            }'''
+
+    def setUp(self):
+        cache.clear()
+        baker.make(Product, _quantity=3)
+
+    def get_pages(self, user):
+        with CaptureQueriesContext(connection) as queries:
+            result = execute_request_with_user(self.query_string, user = user)
+        self.assertNotIn('errors', result)
+        count_queries = [q for q in queries if 'COUNT(' in q['sql']]
+        return result['data']['products']['pages'], len(count_queries)
+
+    def test_count_is_cached(self):
+        user = create_user_from_email('user@marketplace.com')
+        self.assertEqual(self.get_pages(user), (2, 1))
+        self.assertEqual(self.get_pages(user), (2, 0))
+
+    def test_count_is_invalidated_by_new_products(self):
+        user = create_user_from_email('user@marketplace.com')
+        self.assertEqual(self.get_pages(user), (2, 1))
+        baker.make(Product, _quantity=2)
+        self.assertEqual(self.get_pages(user), (3, 1))
+
+
 class TestAllCategoriesQuery(TestCase):
 
     query_string = '''query {
@@ -447,3 +640,235 @@ class TestProductOfferQuery(TestCase):
         error = result["errors"][0]
 
         self.assertEqual(error["message"], "You do not have permission to perform this action")
+
+
+class TestDocumentCache(TestCase):
+
+    query_string = '''query {
+                        myProfile {
+                            name
+                            email
+                        }
+                    }'''
+
+    def test_document_is_parsed_once(self):
+        user = create_user_from_email('user@marketplace.com')
+        execute_request_with_user(self.query_string, user=user)
+        stats = document_backend.documents.stats()
+
+        result = execute_request_with_user(self.query_string, user=user)
+
+        self.assertNotIn('errors', result)
+        self.assertEqual(document_backend.documents.stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(document_backend.documents.stats()['misses'], stats['misses'])
+
+    def test_invalid_document_errors_are_cached(self):
+        user = create_user_from_email('user@marketplace.com')
+        result = execute_request_with_user('query { notAField }', user=user)
+        self.assertIn('errors', result)
+        stats = document_backend.documents.stats()
+
+        with mock.patch('main.schema.backend.validate') as validate:
+            result = execute_request_with_user('query { notAField }', user=user)
+
+        self.assertIn('errors', result)
+        validate.assert_not_called()
+        self.assertEqual(document_backend.documents.stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(document_backend.documents.stats()['misses'], stats['misses'])
+
+
+class TestProductSearch(TestCase):
+
+    query_string = '''query {
+                        searchProducts(querystring: "book", pagesize: 2, page: 1,
+                                       filters: {categories: ["Books"], maxPrice: 500}) {
+                            total
+                            pages
+                            objects { id }
+                            facets { categories { value count } }
+                        }
+                    }'''
+
+    def setUp(self):
+        self.user = create_user_from_email('user@marketplace.com')
+        self.products = baker.make(Product, _quantity=3)
+
+    def test_filters_and_facets_are_built_into_the_search(self):
+        body = elastic.build_product_search("book", {"categories": ["Books"], "max_price": 500, "sold": False}).to_dict()
+
+        self.assertIn({'term': {'sold': False}}, body['query']['bool']['filter'])
+        self.assertIn({'term': {'visible': True}}, body['query']['bool']['filter'])
+        self.assertEqual(
+            body['post_filter']['bool']['filter'],
+            [{'terms': {'category': ['Books']}}, {'range': {'expected_price': {'lte': 500}}}],
+        )
+        # Each facet is narrowed down by the other facet's filter only.
+        self.assertEqual(body['aggs']['categories']['filter'], {'range': {'expected_price': {'lte': 500}}})
+        self.assertEqual(body['aggs']['prices']['filter'], {'terms': {'category': ['Books']}})
+
+    def search(self, query, hits):
+        results = elastic.get_results(
+            [ProductDocument.from_es(hit) for hit in hits],
+            total=len(hits), facets={'categories': [{'value': 'Books', 'count': 2}], 'prices': []},
+            page=1, pages=1, has_next=False, has_prev=False, start_cursor=None, end_cursor=None,
+        )
+        with mock.patch.object(search, 'search_products', return_value=results) as search_products:
+            with CaptureQueriesContext(connection) as queries:
+                result = execute_request_with_user(query, self.user)
+        self.assertNotIn('errors', result)
+        return result['data']['searchProducts'], search_products, len(queries)
+
+    def test_listing_fields_are_served_from_the_index(self):
+        query = self.query_string.replace('objects { id }', 'objects { id name category { name } images(size: THUMBNAIL) }')
+        hits = [
+            {'_id': '7', '_source': {'name': 'Book', 'category': 'Books', 'category_id': 1,
+                                     'images': [{'image': 'images/a.jpg', 'thumbnail': 'thumbs/a.webp'}]}},
+            {'_id': '3', '_source': {'name': 'Pen'}},
+        ]
+
+        data, search_products, num_queries = self.search(query, hits)
+
+        self.assertEqual(num_queries, 0)
+        self.assertEqual(search_products.call_args[0][1]['categories'], ['Books'])
+        self.assertEqual([p['id'] for p in data['objects']], ['7', '3'])
+        self.assertEqual(data['objects'][0]['category'], {'name': 'Books'})
+        self.assertEqual(data['objects'][0]['images'], ['/media/thumbs/a.webp'])
+        self.assertEqual(data['facets']['categories'], [{'value': 'Books', 'count': 2}])
+
+    def test_relations_are_loaded_from_the_database(self):
+        query = self.query_string.replace('objects { id }', 'objects { id offers { amount } }')
+        ids = [self.products[2].id, self.products[0].id]
+
+        data, _, _ = self.search(query, [{'_id': str(pk), '_source': {}} for pk in ids])
+
+        self.assertEqual([int(p['id']) for p in data['objects']], ids)
+
+
+    def test_pages_end_at_the_result_window(self):
+        page_size = 100
+        last_page = elastic.MAX_RESULT_WINDOW // page_size
+        with mock.patch.object(elastic, 'execute', return_value=[]), \
+                mock.patch.object(elastic, 'get_total', return_value=elastic.MAX_RESULT_WINDOW * 3), \
+                mock.patch.object(elastic, 'get_facets', return_value={}):
+            results = elastic.ElasticsearchBackend().search_products('book', {}, page_size, page=last_page + 5)
+
+        self.assertEqual((results.page, results.pages), (last_page, last_page))
+        self.assertFalse(results.has_next)
+
+    def test_cursors_from_other_searches_start_over(self):
+        cursors = [
+            # An offset cursor from the Postgres backend.
+            encode_cursor([20]),
+            # A search without a querystring sorts by date, not by score.
+            encode_cursor(['2020-01-01', 4]),
+            encode_cursor([True, 4]),
+        ]
+        for cursor in cursors:
+            with mock.patch.object(elastic, 'execute', return_value=[]) as execute, \
+                    mock.patch.object(elastic, 'get_total', return_value=0), \
+                    mock.patch.object(elastic, 'get_facets', return_value={}):
+                results = elastic.ElasticsearchBackend().search_products('book', {}, 10, after=cursor)
+
+            self.assertNotIn('search_after', execute.call_args[0][0].to_dict())
+            self.assertFalse(results.has_prev)
+
+    def test_cursor_continues_after_its_hit(self):
+        with mock.patch.object(elastic, 'execute', return_value=[]) as execute, \
+                mock.patch.object(elastic, 'get_total', return_value=0), \
+                mock.patch.object(elastic, 'get_facets', return_value={}):
+            elastic.ElasticsearchBackend().search_products('book', {}, 10, after=encode_cursor([1.5, 4]))
+
+        self.assertEqual(execute.call_args[0][0].to_dict()['search_after'], [1.5, 4])
+
+
+class TestProductSuggestions(TestCase):
+
+    query_string = '''query {
+                        suggestProducts(prefix: "  Text Bo", limit: 3) { id name }
+                    }'''
+
+    def setUp(self):
+        self.user = create_user_from_email('user@marketplace.com')
+        cache.clear()
+
+    def test_suggestions_are_cached_per_prefix(self):
+        hits = [ProductDocument.from_es({'_id': '4', '_source': {'name': 'Textbook'}})]
+        with mock.patch('elasticsearch_dsl.Search.execute', autospec=True, return_value=hits) as execute:
+            for _ in range(2):
+                result = execute_request_with_user(self.query_string, self.user)
+                self.assertNotIn('errors', result)
+                self.assertEqual(result['data']['suggestProducts'], [{'id': '4', 'name': 'Textbook'}])
+            search.suggest_products('text bo', 3)
+
+        execute.assert_called_once()
+        body = execute.call_args[0][0].to_dict()
+        self.assertEqual(body['query']['bool']['must'], [
+            {'match': {'name.autocomplete': {'query': 'text bo', 'operator': 'and'}}},
+        ])
+        self.assertEqual(body['size'], 3)
+
+    def test_blank_prefix_has_no_suggestions(self):
+        with mock.patch('elasticsearch_dsl.Search.execute') as execute:
+            self.assertEqual(search.suggest_products('   '), [])
+        execute.assert_not_called()
+
+
+class TestPostgresSearchBackend(TestCase):
+
+    def setUp(self):
+        books, pens = baker.make(Category, name='Books'), baker.make(Category, name='Pens')
+        self.maths = baker.make(Product, name='Maths book', description='Class 12', expected_price=300, category=books)
+        self.physics = baker.make(Product, name='Physics book', description='HC Verma', expected_price=700, category=books)
+        self.pen = baker.make(Product, name='Pen', description='Writes like a book', expected_price=50, category=pens)
+        baker.make(Product, name='Pencil', description='HB', expected_price=20, category=pens)
+        self.backend = postgres.PostgresBackend()
+        search._primary_down_until = 0
+
+    def tearDown(self):
+        search._primary_down_until = 0
+
+    def test_filters_and_facets(self):
+        results = self.backend.search_products('book', {'categories': ['Books'], 'max_price': 500}, 10, page=1)
+
+        self.assertEqual(results.ids, [self.maths.id])
+        self.assertEqual(results.total, 1)
+        # Each facet is narrowed down by the other facet's filter only.
+        self.assertEqual(results.facets['categories'], [{'value': 'Books', 'count': 1}, {'value': 'Pens', 'count': 1}])
+        self.assertEqual(
+            {f['value']: f['count'] for f in results.facets['prices'] if f['count']},
+            {'100-500': 1, '500-1000': 1},
+        )
+
+    def test_cursor_pages(self):
+        first = self.backend.search_products(None, {}, 3)
+        second = self.backend.search_products(None, {}, 3, after=first.end_cursor)
+        back = self.backend.search_products(None, {}, 3, before=second.start_cursor)
+
+        self.assertEqual(len(first.ids), 3)
+        self.assertTrue(first.has_next)
+        self.assertEqual(len(second.ids), 1)
+        self.assertTrue(second.has_prev)
+        self.assertFalse(second.has_next)
+        self.assertEqual(back.ids, first.ids)
+
+    def test_suggestions_match_word_prefixes(self):
+        self.assertEqual(self.backend.suggest_products('boo', 5), [
+            {'id': self.physics.id, 'name': 'Physics book'},
+            {'id': self.maths.id, 'name': 'Maths book'},
+        ])
+
+    def test_search_fails_over_while_elasticsearch_is_down(self):
+        down = elastic.TransportError('N/A', 'Connection refused')
+        with mock.patch('elasticsearch_dsl.Search.execute', side_effect=down) as execute:
+            first = search.search_products('book', {}, 10, page=1)
+            second = search.search_products('physics', {}, 10, page=1)
+
+        execute.assert_called_once()
+        self.assertIsNone(first.products)
+        self.assertEqual(set(first.ids), {self.maths.id, self.physics.id, self.pen.id})
+        self.assertEqual(second.ids, [self.physics.id])
+
+    def test_bad_queries_are_not_failed_over(self):
+        with mock.patch('elasticsearch_dsl.Search.execute', side_effect=elastic.TransportError(400, 'parsing_exception')):
+            with self.assertRaises(elastic.TransportError):
+                search.search_products('book', {}, 10, page=1)
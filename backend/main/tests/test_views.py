@@ -0,0 +1,312 @@
+import json
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.test.client import RequestFactory
+from graphql_jwt.exceptions import JSONWebTokenExpired
+from graphql_jwt.utils import get_payload
+from model_bakery import baker
+
+from main import google_auth
+from main.auth_helpers import create_user_from_email, get_jwt_with_user
+from main.models import Category, Product, ProductQnA, Profile, User
+from main.schema.backend import query_hash
+from main.tests.utils import GRAPHQL_URL
+from main.uploads import SizeLimitedUploadHandler
+from main.tokens import ClaimsJSONWebTokenBackend, get_user_from_claims
+from main.views.api import PERSISTED_QUERY_PREFIX
+
+
+class TestGraphQLResponseCache(TestCase):
+
+    query_string = '''query {
+                        allCategories {
+                            name
+                        }
+                    }'''
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_user_from_email('user@marketplace.com')
+        self.token = get_jwt_with_user(self.user)
+        baker.make(Category, _quantity=2)
+        # Cache when the user's tokens were last revoked.
+        get_user_from_claims(get_payload(self.token))
+
+    def post(self, query):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                GRAPHQL_URL,
+                json.dumps({'query': query}),
+                content_type='application/json',
+                HTTP_AUTHORIZATION=f'JWT {self.token}',
+            )
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content), len(queries)
+
+    def test_repeated_query_is_served_from_cache(self):
+        first, first_queries = self.post(self.query_string)
+        second, second_queries = self.post(self.query_string)
+
+        self.assertNotIn('errors', first)
+        self.assertEqual(first, second)
+        self.assertLess(second_queries, first_queries)
+
+    def test_cache_is_invalidated_on_write(self):
+        first, _ = self.post(self.query_string)
+        baker.make(Category)
+        second, _ = self.post(self.query_string)
+
+        self.assertEqual(len(first['data']['allCategories']), 2)
+        self.assertEqual(len(second['data']['allCategories']), 3)
+
+    def test_cache_is_invalidated_on_new_question(self):
+        product = baker.make(Product)
+        query = '''query { product(id: %d) { questions { question } } }''' % product.id
+        first, _ = self.post(query)
+        baker.make(ProductQnA, product=product, asked_by=self.user.profile, question='Still available?')
+        second, _ = self.post(query)
+
+        self.assertEqual(first['data']['product']['questions'], [])
+        self.assertEqual(second['data']['product']['questions'], [{'question': 'Still available?'}])
+
+    def test_user_specific_query_is_not_cached(self):
+        query = '''query { myProfile { email } }'''
+        _, first_queries = self.post(query)
+        _, second_queries = self.post(query)
+
+        self.assertEqual(first_queries, second_queries)
+
+
+    def test_wishlist_fields_are_not_cached(self):
+        baker.make(Product, _quantity=2)
+        query = '''query { products(page: 1, pagesize: 5) { objects { ...listing } } }
+                   fragment listing on Product { id inWishlist }'''
+        # Warm the count cache.
+        self.post(query)
+        _, first_queries = self.post(query)
+        _, second_queries = self.post(query)
+
+        self.assertEqual(first_queries, second_queries)
+
+    def test_user_is_authenticated_from_the_token(self):
+        result, num_queries = self.post('''query { myProfile { email } }''')
+
+        self.assertEqual(result['data']['myProfile']['email'], 'user@marketplace.com')
+        # Only the profile itself is loaded.
+        self.assertEqual(num_queries, 1)
+
+
+class TestTokenClaims(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_user_from_email('user@marketplace.com')
+        self.token = get_jwt_with_user(self.user)
+        self.payload = get_payload(self.token)
+
+    def test_claims_are_trusted_without_a_query(self):
+        # The first request reads when the user's tokens were last revoked.
+        with self.assertNumQueries(1):
+            get_user_from_claims(self.payload)
+        with self.assertNumQueries(0):
+            user = get_user_from_claims(self.payload)
+            self.assertEqual(user.profile.permission_level, self.user.profile.permission_level)
+            self.assertEqual(user.profile.id, self.user.profile.id)
+        # Fields the token doesn't carry are loaded on demand.
+        self.assertEqual(user.email, 'user@marketplace.com')
+
+    def test_bans_apply_to_existing_tokens(self):
+        profile = Profile.objects.get(user=self.user)
+        profile.permission_level = Profile.BANNED
+        profile.save()
+
+        self.assertIsNone(get_user_from_claims(self.payload))
+        request = RequestFactory().post(GRAPHQL_URL, HTTP_AUTHORIZATION=f'JWT {self.token}')
+        user = ClaimsJSONWebTokenBackend().authenticate(request)
+        self.assertEqual(user.profile.permission_level, Profile.BANNED)
+
+    def test_bans_apply_without_the_cache(self):
+        profile = Profile.objects.get(user=self.user)
+        profile.permission_level = Profile.BANNED
+        profile.save()
+        cache.clear()
+
+        self.assertIsNone(get_user_from_claims(self.payload))
+        with mock.patch('main.caching.cache.get', return_value=None):
+            self.assertIsNone(get_user_from_claims(self.payload))
+
+    def test_deactivated_users_tokens_are_revoked(self):
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertIsNone(get_user_from_claims(self.payload))
+
+    def test_tokens_without_claims_load_the_user(self):
+        payload = {'username': self.user.username, 'exp': self.payload['exp']}
+
+        self.assertIsNone(get_user_from_claims(payload))
+
+    def test_expired_tokens_are_rejected(self):
+        with mock.patch('rest_framework_jwt.utils.datetime') as clock:
+            clock.utcnow.return_value = datetime.utcnow() - timedelta(days=31)
+            token = get_jwt_with_user(self.user)
+
+        with self.assertRaises(JSONWebTokenExpired):
+            get_payload(token)
+
+
+class TestPersistedQueries(TestCase):
+
+    query_string = '''query {
+                        myProfile {
+                            email
+                        }
+                    }'''
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_user_from_email('user@marketplace.com')
+        self.token = get_jwt_with_user(self.user)
+
+    def post(self, body):
+        return self.client.post(
+            GRAPHQL_URL,
+            json.dumps(body),
+            content_type='application/json',
+            HTTP_AUTHORIZATION=f'JWT {self.token}',
+        )
+
+    def persisted_query(self, sha256_hash):
+        return {'extensions': {'persistedQuery': {'version': 1, 'sha256Hash': sha256_hash}}}
+
+    def test_unknown_hash_is_not_found(self):
+        response = self.post(self.persisted_query(query_hash('query { neverSent }')))
+
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertEqual(result['errors'][0]['message'], 'PersistedQueryNotFound')
+
+    def test_registered_hash_can_be_queried(self):
+        sha256_hash = query_hash(self.query_string)
+        body = dict(self.persisted_query(sha256_hash), query=self.query_string)
+        response = self.post(body)
+        self.assertNotIn('errors', json.loads(response.content))
+
+        response = self.post(self.persisted_query(sha256_hash))
+
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertNotIn('errors', result)
+        self.assertEqual(result['data']['myProfile']['email'], self.user.email)
+
+    @override_settings(GRAPHQL_PERSISTED_QUERY_TIMEOUT=60)
+    def test_registered_hash_expires(self):
+        sha256_hash = query_hash(self.query_string)
+        with mock.patch('main.views.api.cache.set') as cache_set:
+            self.post(dict(self.persisted_query(sha256_hash), query=self.query_string))
+
+        cache_set.assert_any_call(f'{PERSISTED_QUERY_PREFIX}:{sha256_hash}', self.query_string, 60)
+
+    def test_mismatched_hash_is_rejected(self):
+        body = dict(self.persisted_query('0' * 64), query=self.query_string)
+        response = self.post(body)
+
+        self.assertEqual(response.status_code, 400)
+
+
+class TestUploadLimits(TestCase):
+
+    query_string = '''mutation($file: Upload) {
+                        uploadImage(input: { productId: 1 }, file: $file) {
+                            ok
+                        }
+                    }'''
+
+    def setUp(self):
+        self.user = create_user_from_email('f20190663@pilani.bits-pilani.ac.in')
+        self.token = get_jwt_with_user(self.user)
+
+    def upload(self, *sizes):
+        files = {str(i): SimpleUploadedFile(f'image{i}.jpg', b'0' * size) for i, size in enumerate(sizes)}
+        return self.client.post(
+            GRAPHQL_URL,
+            {
+                'operations': json.dumps({'query': self.query_string, 'variables': {'file': None}}),
+                'map': json.dumps({name: ['variables.file'] for name in files}),
+                **files,
+            },
+            HTTP_AUTHORIZATION=f'JWT {self.token}',
+        )
+
+    @override_settings(MAX_UPLOAD_FILE_SIZE=1024)
+    def test_large_file_is_rejected(self):
+        response = self.upload(2048)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('image0.jpg', json.loads(response.content)['errors'][0]['message'])
+
+    @override_settings(MAX_UPLOAD_REQUEST_SIZE=1024)
+    def test_large_request_is_rejected(self):
+        response = self.upload(2048)
+
+        self.assertEqual(response.status_code, 413)
+
+    @override_settings(MAX_UPLOAD_REQUEST_SIZE=1024)
+    def test_request_with_wrong_content_length_is_rejected(self):
+        # Let the Content-Length through, as if it were wrong or missing.
+        with mock.patch.object(SizeLimitedUploadHandler, 'handle_raw_input', return_value=None):
+            response = self.upload(600, 600)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('per request', json.loads(response.content)['errors'][0]['message'])
+
+
+def verify_test_id_token(id_token):
+    """
+    Local stand-in for Google's verification: the token is the email.
+    """
+    if '@' not in id_token:
+        raise ValueError('Invalid token')
+    return {'iss': 'accounts.google.com', 'email': id_token}
+
+
+@override_settings(GOOGLE_ID_TOKEN_VERIFIER='main.tests.test_views.verify_test_id_token')
+class TestGoogleAuth(TestCase):
+
+    def setUp(self):
+        google_auth._certs = None
+
+    def sign_in(self, id_token):
+        return self.client.post(reverse('auth-authenticate'), {'id_token': id_token})
+
+    def test_user_is_created_on_first_sign_in(self):
+        response = self.sign_in('buyer@gmail.com')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['username'], 'buyer')
+        self.assertTrue(User.objects.filter(username='buyer').exists())
+
+    def test_invalid_token_is_forbidden(self):
+        response = self.sign_in('not a token')
+
+        self.assertEqual(response.status_code, 403)
+
+    def test_certs_are_cached_for_their_max_age(self):
+        response = mock.Mock(headers={'Cache-Control': 'public, max-age=100'})
+        response.json.return_value = {'key': 'cert'}
+        with mock.patch.object(google_auth.session, 'get', return_value=response) as get, \
+                mock.patch.object(google_auth.time, 'monotonic', return_value=1000):
+            self.assertEqual(google_auth.get_certs(), {'key': 'cert'})
+            google_auth.get_certs()
+            self.assertEqual(get.call_count, 1)
+
+            google_auth.time.monotonic.return_value = 1101
+            google_auth.get_certs()
+            self.assertEqual(get.call_count, 2)
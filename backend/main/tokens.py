@@ -0,0 +1,99 @@
+"""
+Tokens carry the user's profile id and permission level, so most requests are
+authenticated from the token alone, without loading the user. Once a user's permissions
+change (e.g. they are banned), their older tokens are checked against the database again,
+see models.revoke_tokens.
+"""
+from calendar import timegm
+from datetime import datetime
+
+from django.contrib.auth.models import User
+from graphql_jwt.backends import JSONWebTokenBackend
+from graphql_jwt.utils import get_credentials, get_payload, get_user_by_payload
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework_jwt.utils import jwt_payload_handler
+
+from main import caching
+from main.models import Profile
+
+CLAIMS = ("user_id", "username", "profile_id", "permission_level", "iat")
+
+
+def jwt_payload(user):
+    """
+    JWT_PAYLOAD_HANDLER that adds the user's profile and permission level to the default claims.
+    """
+    payload = jwt_payload_handler(user)
+    payload["iat"] = timegm(datetime.utcnow().utctimetuple())
+    payload["profile_id"] = user.profile.id
+    payload["permission_level"] = user.profile.permission_level
+    return payload
+
+
+def get_tokens_valid_after(payload):
+    """
+    Timestamp before which the tokens of the payload's user aren't trusted (0 if they all are),
+    or None if their profile doesn't exist. Read from the cache, or the database when the
+    entry is missing or the cache is unavailable, so a lost entry never means "trusted".
+    """
+    valid_after = caching.cached_tokens_valid_after(payload["user_id"])
+    if valid_after is not None:
+        return valid_after
+
+    profiles = Profile.objects.filter(pk=payload["profile_id"], user_id=payload["user_id"])
+    rows = list(profiles.values_list("tokens_valid_after", flat=True))
+    if not rows:
+        return None
+    valid_after = rows[0].timestamp() if rows[0] is not None else 0
+    caching.cache_tokens_valid_after(payload["user_id"], valid_after)
+    return valid_after
+
+
+def get_user_from_claims(payload):
+    """
+    Build the user a token belongs to, and their profile, from the token's claims.
+    Returns None if the token doesn't have the claims, or was issued before the user's
+    tokens were last revoked.
+
+    The other fields are deferred, so reading them loads them from the database.
+    """
+    if not all(claim in payload for claim in CLAIMS):
+        return None
+    valid_after = get_tokens_valid_after(payload)
+    if valid_after is None or payload["iat"] <= valid_after:
+        return None
+
+    # from_db takes the values in the order of the model's fields.
+    user = User.from_db("default", ["id", "username", "is_active"], [payload["user_id"], payload["username"], True])
+    profile = Profile.from_db(
+        "default",
+        ["id", "user_id", "permission_level"],
+        [payload["profile_id"], payload["user_id"], payload["permission_level"]],
+    )
+    User.profile.related.set_cached_value(user, profile)
+    Profile.user.field.set_cached_value(profile, user)
+    return user
+
+
+class ClaimsJSONWebTokenBackend(JSONWebTokenBackend):
+    """
+    graphql_jwt's authentication backend, using the token's claims when they can be trusted.
+    """
+
+    def authenticate(self, request=None, **kwargs):
+        if request is None or getattr(request, "_jwt_token_auth", False):
+            return None
+        token = get_credentials(request, **kwargs)
+        if token is None:
+            return None
+        payload = get_payload(token, request)
+        return get_user_from_claims(payload) or get_user_by_payload(payload)
+
+
+class ClaimsJSONWebTokenAuthentication(JSONWebTokenAuthentication):
+    """
+    The REST framework's JWT authentication, using the token's claims when they can be trusted.
+    """
+
+    def authenticate_credentials(self, payload):
+        return get_user_from_claims(payload) or super().authenticate_credentials(payload)
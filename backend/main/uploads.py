@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.http import QueryDict
+from django.template.defaultfilters import filesizeformat
+from django.utils.datastructures import MultiValueDict
+
+
+class SizeLimitedUploadHandler(FileUploadHandler):
+    """
+    Upload handler that enforces settings.MAX_UPLOAD_REQUEST_SIZE and settings.MAX_UPLOAD_FILE_SIZE
+    while the body is streamed, before the data reaches the handlers after it in
+    FILE_UPLOAD_HANDLERS. Requests over the limit are not read any further.
+
+    Content-Length is checked up front, but the bytes actually received are counted too, so
+    chunked requests and requests with a wrong Content-Length are stopped all the same.
+
+    The reason a request was rejected is left in `request.upload_error`, see main.views.api.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        # Bytes of file data received so far, over all the files in the request.
+        self.received = 0
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length > settings.MAX_UPLOAD_REQUEST_SIZE:
+            self.request.upload_error = (
+                f"Uploads are limited to {filesizeformat(settings.MAX_UPLOAD_REQUEST_SIZE)} per request."
+            )
+            # Don't parse the body at all.
+            return QueryDict(encoding=encoding), MultiValueDict()
+        return None
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > settings.MAX_UPLOAD_REQUEST_SIZE:
+            self.request.upload_error = (
+                f"Uploads are limited to {filesizeformat(settings.MAX_UPLOAD_REQUEST_SIZE)} per request."
+            )
+            raise StopUpload(connection_reset=True)
+        if start + len(raw_data) > settings.MAX_UPLOAD_FILE_SIZE:
+            self.request.upload_error = (
+                f"{self.file_name} is larger than {filesizeformat(settings.MAX_UPLOAD_FILE_SIZE)}."
+            )
+            raise StopUpload(connection_reset=True)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
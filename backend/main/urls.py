@@ -1,14 +1,12 @@
 from django.urls import path
 from django.views.decorators.csrf import csrf_exempt
-from graphene_django.views import GraphQLView
-from graphene_file_upload.django import FileUploadGraphQLView
 
-from marketplace.schema import schema
+from marketplace.schema import document_backend, schema
 
-from .views import auth, content, index
+from .views import api, auth, content, index
 
 urlpatterns = [
     path("", index.index, name="index"),
-    path("api/graphql/", csrf_exempt(FileUploadGraphQLView.as_view(graphiql=True, schema=schema))),
+    path("api/graphql/", csrf_exempt(api.CachedGraphQLView.as_view(graphiql=True, schema=schema, backend=document_backend))),
     path("auth/authenticate/", auth.authenticate, name="auth-authenticate"),
 ]
@@ -0,0 +1,195 @@
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseBadRequest
+from graphene_django.views import HttpError
+from graphene_file_upload.django import FileUploadGraphQLView
+from graphql.language import ast
+from graphql.language.printer import print_ast
+from graphql_jwt.exceptions import JSONWebTokenError
+from graphql_jwt.settings import jwt_settings
+from graphql_jwt.utils import get_http_authorization, get_payload
+
+from main import caching
+from main.models import Profile
+from main.schema.backend import query_hash
+from main.tokens import get_user_from_claims
+
+# Root query fields whose results are the same for every user with the same permission level.
+CACHEABLE_FIELDS = {"allCategories", "category", "product", "products"}
+# Fields that depend on the requesting user wherever they are selected.
+USER_SPECIFIC_FIELDS = {"inWishlist"}
+
+# Cached responses are dropped whenever a row of one of these models changes, see main.models.
+RESPONSE_CACHE_TAGS = [
+    "main.category",
+    "main.imagemodel",
+    "main.product",
+    "main.productoffer",
+    "main.productqna",
+    "main.profile",
+    "main.userreport",
+]
+
+PERSISTED_QUERY_PREFIX = "persisted-query"
+
+
+def get_permission_level(request):
+    """
+    Permission level of the user the request's JWT belongs to, or None for anonymous requests.
+    """
+    token = get_http_authorization(request)
+    if token is None:
+        return None
+    try:
+        payload = get_payload(token, request)
+    except JSONWebTokenError:
+        return None
+    user = get_user_from_claims(payload)
+    if user is not None:
+        return user.profile.permission_level
+    username = jwt_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER(payload)
+    return (
+        Profile.objects.filter(user__username=username, user__is_active=True)
+        .values_list("permission_level", flat=True)
+        .first()
+    )
+
+
+def get_persisted_query_hash(request, data):
+    """
+    sha256 hash of an automatic persisted query from the request's `extensions`, or None.
+    """
+    extensions = request.GET.get("extensions") or data.get("extensions")
+    if isinstance(extensions, str):
+        try:
+            extensions = json.loads(extensions)
+        except ValueError:
+            raise HttpError(HttpResponseBadRequest("Extensions are invalid JSON."))
+    if not isinstance(extensions, dict):
+        return None
+    persisted_query = extensions.get("persistedQuery")
+    if not isinstance(persisted_query, dict):
+        return None
+    return persisted_query.get("sha256Hash")
+
+
+def get_operation(document, operation_name):
+    operations = [
+        definition for definition in document.definitions
+        if isinstance(definition, ast.OperationDefinition)
+    ]
+    if operation_name is None:
+        return operations[0] if len(operations) == 1 else None
+    for operation in operations:
+        if operation.name is not None and operation.name.value == operation_name:
+            return operation
+    return None
+
+
+def selects_any(node, names):
+    """
+    Whether a field named one of `names` is selected anywhere below `node`.
+    """
+    selection_set = getattr(node, "selection_set", None)
+    if selection_set is None:
+        return False
+    return any(
+        (isinstance(selection, ast.Field) and selection.name.value in names) or selects_any(selection, names)
+        for selection in selection_set.selections
+    )
+
+
+def is_cacheable(document, operation_name):
+    operation = get_operation(document, operation_name)
+    if operation is None or operation.operation != "query":
+        return False
+    if any(selects_any(definition, USER_SPECIFIC_FIELDS) for definition in document.definitions):
+        return False
+    return all(
+        isinstance(selection, ast.Field) and selection.name.value in CACHEABLE_FIELDS
+        for selection in operation.selection_set.selections
+    )
+
+
+class CachedGraphQLView(FileUploadGraphQLView):
+    """
+    GraphQL view that serves repeated read-only queries from the cache.
+    Responses are keyed by the normalized query document, its variables and the
+    permission level of the requesting user.
+
+    Also implements automatic persisted queries: clients may send only the sha256 of a
+    query in `extensions.persistedQuery.sha256Hash`. Unknown hashes get a
+    `PersistedQueryNotFound` error, after which the client resends the hash with the
+    full query and it is registered for every worker through the cache, for
+    GRAPHQL_PERSISTED_QUERY_TIMEOUT seconds.
+    """
+
+    def parse_body(self, request):
+        if self.get_content_type(request) == "multipart/form-data":
+            # Reading FILES streams the body through the upload handlers, see main.uploads.
+            request.FILES
+            upload_error = getattr(request, "upload_error", None)
+            if upload_error is not None:
+                raise HttpError(HttpResponse(status=413), upload_error)
+        return super().parse_body(request)
+
+    def get_persisted_query(self, request, sha256_hash, query):
+        key = f"{PERSISTED_QUERY_PREFIX}:{sha256_hash}"
+        if query:
+            if query_hash(query) != sha256_hash:
+                raise HttpError(HttpResponseBadRequest("provided sha does not match query"))
+            cache.set(key, query, settings.GRAPHQL_PERSISTED_QUERY_TIMEOUT)
+            return query
+
+        # Documents parsed by this worker already carry their text.
+        document = self.get_backend(request).get_document(self.schema, sha256_hash)
+        if document is not None:
+            return document.document_string
+
+        query = cache.get(key)
+        if query is None:
+            raise HttpError(HttpResponse(), "PersistedQueryNotFound")
+        return query
+
+    def get_graphql_params(self, request, data):
+        query, variables, operation_name, id = super().get_graphql_params(request, data)
+        sha256_hash = get_persisted_query_hash(request, data)
+        if sha256_hash is not None:
+            query = self.get_persisted_query(request, sha256_hash, query)
+        return query, variables, operation_name, id
+
+    def get_cache_key(self, request, data):
+        query, variables, operation_name, _ = self.get_graphql_params(request, data)
+        if not query:
+            return None
+        try:
+            document = self.get_backend(request).document_from_string(self.schema, query).document_ast
+        except Exception:
+            return None
+        if not is_cacheable(document, operation_name):
+            return None
+
+        return caching.make_key(
+            "graphql",
+            RESPONSE_CACHE_TAGS,
+            print_ast(document),
+            json.dumps(variables, sort_keys=True),
+            operation_name,
+            get_permission_level(request),
+        )
+
+    def get_response(self, request, data, show_graphiql=False):
+        key = None if show_graphiql else self.get_cache_key(request, data)
+        if key is None:
+            return super().get_response(request, data, show_graphiql)
+
+        result = cache.get(key)
+        if result is not None:
+            return result, 200
+
+        result, status_code = super().get_response(request, data, show_graphiql)
+        if status_code == 200 and result is not None and "errors" not in json.loads(result):
+            cache.set(key, result, settings.GRAPHQL_RESPONSE_CACHE_TIMEOUT)
+        return result, status_code
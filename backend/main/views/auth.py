@@ -1,11 +1,11 @@
 import logging
 
-from google.auth.transport import requests as google_requests
-from google.oauth2 import id_token as googleIdToken
+from django.db import IntegrityError
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
+from main import google_auth
 from main.auth_helpers import create_user_from_email, get_jwt_with_user
 from main.models import Profile, User
 
@@ -23,7 +23,12 @@ def authenticate(request):
             {"error": "No id_token provided"}, status=status.HTTP_403_FORBIDDEN
         )
 
-    id_info = googleIdToken.verify_oauth2_token(id_token, google_requests.Request())
+    try:
+        id_info = google_auth.verify(id_token)
+    except ValueError:
+        return Response(
+            {"error": "Invalid id_token"}, status=status.HTTP_403_FORBIDDEN
+        )
 
     if id_info["iss"] not in ["accounts.google.com", "https://accounts.google.com"]:
         return Response(
@@ -39,7 +44,11 @@ def authenticate(request):
     try: 
         user = User.objects.get(username=username)
     except User.DoesNotExist:
-        user = create_user_from_email(email)
+        try:
+            user = create_user_from_email(email)
+        except IntegrityError:
+            # Created by a concurrent first login of the same user.
+            user = User.objects.get(username=username)
 
     token = get_jwt_with_user(user)
 
@@ -19,3 +19,7 @@ class PostgresDB:
 
 class Elasticsearch:
     HOSTS = str(os.getenv("SEARCH_HOST"))+":"+str(os.getenv("SEARCH_PORT")) or "localhost:9200"
+
+
+class Redis:
+    LOCATION = os.getenv("REDIS_URL") or "redis://localhost:6379/1"
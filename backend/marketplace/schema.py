@@ -1,7 +1,10 @@
 import graphene
 import graphql_jwt
+from django.conf import settings
+from graphql.backend import set_default_backend
 
 import main.schema
+from main.schema.backend import ValidatedDocumentBackend
 
 
 class Query(main.schema.Query, graphene.ObjectType):
@@ -12,3 +15,7 @@ class Mutation(main.schema.Mutation, graphene.ObjectType):
     pass
 
 schema = graphene.Schema(query=Query, mutation=Mutation)
+
+# Parse and validate each distinct document once per worker, for the view and schema.execute alike.
+document_backend = ValidatedDocumentBackend(max_size=settings.GRAPHQL_DOCUMENT_CACHE_SIZE)
+set_default_backend(document_backend)
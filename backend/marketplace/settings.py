@@ -11,7 +11,8 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
-from marketplace.keyconfig import Secrets, Elasticsearch, PostgresDB
+from datetime import timedelta
+from marketplace.keyconfig import Secrets, Elasticsearch, PostgresDB, Redis
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -110,19 +111,68 @@ DATABASES = {
 
 CELERY_BROKER_URL = "amqp://broker"
 
-# CACHES = {
-#     "default": {
-#         "BACKEND": "django_redis.cache.RedisCache",
-#         "LOCATION": "redis://127.0.0.1:6379/1",
-#         "OPTIONS": {"CLIENT_CLASS": "django_redis.client.DefaultClient",},
-#         "KEY_PREFIX": "example",
-#     }
-# }
+# Side effects of writes are recorded in the outbox table and applied in batches by
+# celery beat, see main.outbox.
+OUTBOX_DRAIN_INTERVAL = 1.0
+OUTBOX_BATCH_SIZE = 500
+# Events that failed this many times are left in the outbox for inspection, not retried.
+OUTBOX_MAX_ATTEMPTS = 5
+
+# Changed products are queued in Redis and indexed in bulk, see main.indexing.
+SEARCH_INDEX_FLUSH_INTERVAL = 0.5
+SEARCH_INDEX_BATCH_SIZE = 500
+
+# Search backends, see main.search. Queries fail over to SEARCH_FALLBACK_BACKEND for
+# SEARCH_FAILOVER_TIMEOUT seconds whenever SEARCH_BACKEND is unavailable. Set
+# SEARCH_BACKEND=main.search.postgres.PostgresBackend to run without Elasticsearch.
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "main.search.elastic.ElasticsearchBackend")
+SEARCH_FALLBACK_BACKEND = "main.search.postgres.PostgresBackend"
+SEARCH_FAILOVER_TIMEOUT = 30
+
+CELERY_BEAT_SCHEDULE = {
+    "drain-outbox": {
+        "task": "main.tasks.drain_outbox",
+        "schedule": OUTBOX_DRAIN_INTERVAL,
+    },
+    "flush-search-index": {
+        "task": "main.tasks.flush_search_index",
+        "schedule": SEARCH_INDEX_FLUSH_INTERVAL,
+    },
+    "collect-images": {
+        "task": "main.tasks.collect_images",
+        "schedule": 60 * 60,
+    },
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": Redis.LOCATION,
+        "OPTIONS": {
+            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            # Treat an unreachable Redis as a cache miss instead of failing the request.
+            "IGNORE_EXCEPTIONS": True,
+        },
+        "KEY_PREFIX": "marketplace",
+    }
+}
+
+# Seconds a cached read-only GraphQL response is served for. Writes to the models it
+# depends on invalidate it earlier, see main.views.api.
+GRAPHQL_RESPONSE_CACHE_TIMEOUT = 60 * 5
+
+# Number of parsed and validated query documents each worker keeps in memory.
+GRAPHQL_DOCUMENT_CACHE_SIZE = 256
+
+# Seconds an automatic persisted query is kept after it was registered. Registration needs no
+# authentication, so they expire; clients register them again on PersistedQueryNotFound.
+GRAPHQL_PERSISTED_QUERY_TIMEOUT = 60 * 60 * 24
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
 AUTHENTICATION_BACKENDS = [
-    "graphql_jwt.backends.JSONWebTokenBackend",
+    "main.tokens.ClaimsJSONWebTokenBackend",
     "django.contrib.auth.backends.ModelBackend",
 ]
 
@@ -159,10 +209,19 @@ STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "mediafiles")
 
+# Uploads are streamed to temporary files in chunks and moved into MEDIA_ROOT, never held in memory.
+# Keep MAX_UPLOAD_REQUEST_SIZE in sync with client_max_body_size in nginx.
+FILE_UPLOAD_HANDLERS = [
+    "main.uploads.SizeLimitedUploadHandler",
+    "django.core.files.uploadhandler.TemporaryFileUploadHandler",
+]
+MAX_UPLOAD_FILE_SIZE = 5 * 1024 * 1024
+MAX_UPLOAD_REQUEST_SIZE = 25 * 1024 * 1024
+
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_jwt.authentication.JSONWebTokenAuthentication",
+        "main.tokens.ClaimsJSONWebTokenAuthentication",
         "rest_framework.authentication.SessionAuthentication",
         "rest_framework.authentication.BasicAuthentication",
     ),
@@ -170,9 +229,18 @@ REST_FRAMEWORK = {
     "PAGE_SIZE": 3,
 }
 
+# Verifies the Google ID tokens users sign in with, see main.google_auth.
+GOOGLE_ID_TOKEN_VERIFIER = "main.google_auth.verify_id_token"
+
+# Tokens carry the user's profile id and permission level, see main.tokens.
 JWT_AUTH = {
-    "JWT_VERIFY_EXPIRATION": False,
+    "JWT_PAYLOAD_HANDLER": "main.tokens.jwt_payload",
+    "JWT_VERIFY_EXPIRATION": True,
+    "JWT_EXPIRATION_DELTA": timedelta(days=30),
 }
+# Seconds the time a user's tokens were last revoked (Profile.tokens_valid_after) is cached for.
+# Bounds how long a revocation whose cache update was lost takes to apply.
+TOKEN_REVOCATION_CACHE_TIMEOUT = 10
 
 # ---------LOGGING----------
 
@@ -215,6 +283,7 @@ ELASTICSEARCH_DSL = {
         "hosts": Elasticsearch.HOSTS,
     },
 }
+ELASTICSEARCH_DSL_SIGNAL_PROCESSOR = "main.indexing.QueuedSignalProcessor"
 
 CORS_ORIGIN_ALLOW_ALL = True
 
@@ -227,4 +296,6 @@ INTERNAL_IPS = [
 
 GRAPHQL_JWT = {
     "JWT_ALLOW_ARGUMENT": True,
+    "JWT_VERIFY_EXPIRATION": True,
+    "JWT_GET_USER_BY_NATURAL_KEY_HANDLER": "main.auth_helpers.get_user_by_natural_key",
 }